@@ -1,13 +1,179 @@
 import random
 import math
 import csv
+import os
+import sys
+import json
+import time
+import heapq
+import hashlib
+import weakref
+import importlib
+import importlib.util
+import itertools
+import collections
+
+# the standard library modules that only some commands need (argparse, asyncio, sqlite3,
+# concurrent.futures, multiprocessing, tempfile, cProfile and pstats) are imported in the functions that use them, and numpy and
+# pyarrow only on first use, so importing this file stays cheap.
+
+class Lazy_Module():
+    # stands in for an optional module, and imports it (and any submodules) the first time an attribute is asked for
+    def __init__(self, name, submodules=[]):
+        self.module_name = name
+        self.submodules = submodules
+
+    def __getattr__(self, attribute):
+        if attribute in ['module_name', 'submodules']:
+            raise AttributeError(attribute)
+        module = importlib.import_module(self.module_name)
+        for submodule in self.submodules:
+            importlib.import_module(submodule)
+        value = getattr(module, attribute)
+        setattr(self, attribute, value) # later lookups skip __getattr__
+        return(value)
+
+def get_optional_module(name, submodules=[]):
+    # None if the module is not installed, otherwise a Lazy_Module for it
+    if importlib.util.find_spec(name) is None:
+        return(None)
+    return(Lazy_Module(name, submodules))
+
+np = get_optional_module('numpy') # only the batch simulator and binary logs need numpy
+pyarrow = get_optional_module('pyarrow', ['pyarrow.ipc', 'pyarrow.parquet']) # only parquet and arrow logs need pyarrow
 
 global_verbose_flag = False
+instrumentation = None # set by enable_instrumentation.  while None, nothing below pays for instrumentation.
+
+def roll_die(n, rng=random):
+    return(math.ceil(rng.random() * n))
+
+def get_die_roller(rng):
+    # a function from die size to roll, for the simulation loop.  uses the rng's own roll_die if it has one, and
+    # otherwise rolls exactly as roll_die does, so seeded runs come out the same.
+    if hasattr(rng, 'roll_die'):
+        return(rng.roll_die)
+    random_func = rng.random
+    def roll(n):
+        return(math.ceil(random_func() * n))
+    return(roll)
+
+class Mersenne_Rng(random.Random):
+    # the standard library generator, with roll_die.  gives exactly the same streams as random.Random(seed), or
+    # as random.seed(seed) and the module functions, so old datasets can be regenerated.
+    def roll_die(self, n):
+        return(math.ceil(self.random() * n))
+
+class Block_Rng():
+    # numpy's PCG64, drawn a block at a time into lists that the simulation reads one value from per call.
+    # each die size gets its own stream of ready-made rolls, so rolling a die is one dict lookup and one list step.
+    # streams are reproducible for a given seed, but are not the same as the Mersenne Twister's.
+    def __init__(self, seed=None, block_size=65536):
+        if np is None:
+            raise ImportError('Block_Rng requires numpy')
+        if seed is not None and not isinstance(seed, int):
+            seed = int(hashlib.sha256(str(seed).encode()).hexdigest()[:16], 16)
+        self.generator = np.random.Generator(np.random.PCG64(seed))
+        self.block_size = block_size
+        self.next_random = self.get_stream(lambda: self.generator.random(self.block_size))
+        self.die_rolls = {} # die size -> function returning the next roll
+        die_rolls = self.die_rolls
+        def roll_die(n): # a closure rather than a method, as this is called once per die
+            try:
+                return(die_rolls[n]())
+            except KeyError:
+                die_rolls[n] = self.get_stream(lambda: self.generator.integers(1, n + 1, size=self.block_size))
+                return(die_rolls[n]())
+        self.roll_die = roll_die
+
+    def get_stream(self, draw_block):
+        def stream():
+            while True:
+                yield from draw_block().tolist()
+        return(stream().__next__)
+
+    def random(self):
+        return(self.next_random())
+
+    def choice(self, seq):
+        return(seq[int(self.next_random() * len(seq))])
+
+    def shuffle(self, x):
+        for i in reversed(range(1, len(x))):
+            j = int(self.next_random() * (i + 1))
+            x[i], x[j] = x[j], x[i]
+
+rng_backends = { 'mersenne' : Mersenne_Rng, 'block' : Block_Rng }
+
+def make_rng(seed=None, backend='mersenne'):
+    return(rng_backends[backend](seed))
+
+class Instrumentation():
+    # per encounter type counters and per phase timing histograms, filled in by Party.run_dungeon and
+    # World.run_dungeon while enabled.  histogram bucket k counts times from 2^k to 2^(k+1) microseconds.
+    phases = [ 'dungeon_setup', 'party_selection', 'fight', 'logging' ]
+
+    def __init__(self):
+        self.encounters = {} # encounter type name -> { 'calls', 'total_damage', 'deaths' }
+        self.timings = {}
+        for phase in self.phases:
+            self.timings[phase] = { 'count' : 0, 'total_seconds' : 0.0, 'histogram' : {} }
+
+    def record_encounter(self, e_name, damage, died):
+        if e_name not in self.encounters:
+            self.encounters[e_name] = { 'calls' : 0, 'total_damage' : 0, 'deaths' : 0 }
+        counters = self.encounters[e_name]
+        counters['calls'] += 1
+        counters['total_damage'] += damage
+        if died:
+            counters['deaths'] += 1
+
+    def record_time(self, phase, seconds):
+        timing = self.timings[phase]
+        timing['count'] += 1
+        timing['total_seconds'] += seconds
+        bucket = max(0, int(math.log2(max(seconds * 1e6, 1))))
+        timing['histogram'][bucket] = timing['histogram'].get(bucket, 0) + 1
+
+    def get_report(self):
+        return({ 'encounters' : self.encounters, 'timings' : self.timings })
+
+    def write_json(self, location):
+        with open(location, 'w') as f:
+            json.dump(self.get_report(), f, indent=2)
 
-def roll_die(n):
-    return(math.ceil(random.random() * n))
+    def print_self(self):
+        for e_name, counters in self.encounters.items():
+            print('{}: {} calls, {:.2f} average damage, {} deaths'.format(e_name, counters['calls'], counters['total_damage'] / counters['calls'], counters['deaths']))
+        for phase, timing in self.timings.items():
+            if timing['count']:
+                print('{}: {} calls, {:.2f}us average'.format(phase, timing['count'], 1e6 * timing['total_seconds'] / timing['count']))
+
+def enable_instrumentation():
+    global instrumentation
+    instrumentation = Instrumentation()
+    return(instrumentation)
+
+def disable_instrumentation():
+    global instrumentation
+    finished = instrumentation
+    instrumentation = None
+    return(finished)
+
+def profile_call(func, location=None):
+    # runs func() under cProfile and returns its pstats.Stats, also saved to location if given
+    import cProfile
+    import pstats
+    profile = cProfile.Profile()
+    profile.runcall(func)
+    stats = pstats.Stats(profile)
+    if location is not None:
+        stats.dump_stats(location)
+    return(stats)
 
 class Char_Class():
+    __slots__ = ['name', 'melee_guard', 'range_guard', 'magic_guard', 'healing', 'wild_empathy', 'cowardly']
+
     def __init__(self, name, melee_guard, range_guard, magic_guard, healing, wild_empathy, cowardly):
         self.name = name
         self.melee_guard = melee_guard
@@ -18,6 +184,8 @@ class Char_Class():
         self.cowardly = cowardly
 
 class Adventurer():
+    __slots__ = ['char_class', 'level', 'melee_guard', 'range_guard', 'magic_guard', 'healing', 'wild_empathy']
+
     def __init__(self, char_class, level):
         self.char_class = char_class
         self.level = level
@@ -33,6 +201,8 @@ class Adventurer():
     
         
 class Party():
+    __slots__ = ['world', 'adventurers', 'total_hp', 'current_hp', 'guards', 'healing', 'wild_empathy', 'class_max_levels', 'signature']
+
     def __init__(self, world, adventurers):
         self.world = world
         self.adventurers = adventurers
@@ -51,28 +221,44 @@ class Party():
         for c in self.world.char_classes:
             levels = [0] + [a.level for a in self.adventurers if a.char_class == c]
             self.class_max_levels[c.name] = max(levels)
+        # everything about the party that encounter results depend on, other than HP
+        self.signature = (tuple(self.guards), self.healing > 0, self.wild_empathy, tuple(self.class_max_levels.values()))
+
+    def copy(self, adventurers=None):
+        # a fresh party at full HP with the same stats, optionally listing the same adventurers in another order.
+        # guards and class_max_levels are shared, which is fine as nothing changes them after __init__.
+        party = Party.__new__(Party)
+        party.world = self.world
+        party.adventurers = adventurers if adventurers is not None else list(self.adventurers)
+        party.total_hp = self.total_hp
+        party.current_hp = self.total_hp
+        party.guards = self.guards
+        party.healing = self.healing
+        party.wild_empathy = self.wild_empathy
+        party.class_max_levels = self.class_max_levels
+        party.signature = self.signature
+        return(party)
 
     def log_dungeon(self, dungeon):
+        encounter_types = self.world.encounter_types
         party_log = [dungeon.name]
         for a in self.adventurers:
             party_log.append(a.char_class.name)
             party_log.append(a.level)
-        encounter_list = [(e.encounter_type.name) for e in dungeon.encounters]
+        encounter_list = [ encounter_types[i].name for i in dungeon.encounter_codes ]
         while len(encounter_list) < self.world.max_dungeon_length:
             encounter_list.append('')
         assert(len(encounter_list) == self.world.max_dungeon_length)
         threat_level = dungeon.get_threat_level()
-        num_encounters = len(dungeon.encounters)
-        num_beaten = len([e for e in dungeon.encounters if e.beaten == True])
+        num_encounters = len(dungeon.encounter_codes)
+        num_beaten = dungeon.num_beaten
         victory = 1 if num_encounters == num_beaten else 0
         log = party_log + encounter_list + [threat_level, num_encounters, num_beaten, victory]
 
         # what you were beated by:
         beaten_by = ''
-        for encounter in dungeon.encounters:
-            if encounter.beaten == False:
-                beaten_by = encounter.encounter_type.name
-                break
+        if num_beaten < num_encounters:
+            beaten_by = encounter_types[dungeon.encounter_codes[num_beaten]].name
 
         log.append(beaten_by)
         
@@ -86,30 +272,81 @@ class Party():
             extended_log.append(sum([0]+[a.level for a in class_list]))
             extended_log.append(max([0]+[a.level for a in class_list]))
             
-        for encounter_type in self.world.encounter_types:
-            enc_list = [ e for e in dungeon.encounters if e.encounter_type == encounter_type]
-            extended_log.append(len(enc_list))
+        encounter_counts = [ 0 for e_type in encounter_types ]
+        for i in dungeon.encounter_codes:
+            encounter_counts[i] += 1
+        extended_log.extend(encounter_counts)
 
         self.world.log(extended_log, extended_log=True)
 
+        if len(self.world.log_listeners):
+            row = dict(zip(self.world.extended_log_headers, extended_log))
+            for listener in self.world.log_listeners:
+                listener.add_row(row)
+
     def heal(self):
         self.current_hp = min(self.total_hp, self.current_hp + self.healing)
         
     def run_dungeon(self, dungeon, log=True):
-        for e in dungeon.encounters:
-            e.encountered = True
+        if global_verbose_flag or instrumentation is not None:
+            return(self.run_dungeon_instrumented(dungeon, log))
+        compiled = self.world.get_compiled_party(self)
+        roll = self.world.roll_die
+        dungeon.num_encountered = 0
+        dungeon.num_beaten = 0
+        for i in dungeon.encounter_codes:
+            dungeon.num_encountered += 1
+            damage = 0
+            for n in compiled.dice[i]:
+                damage = damage + roll(n)
+            damage = (damage - compiled.offsets[i]) * compiled.multipliers[i]
+            if damage > 0:
+                self.current_hp = self.current_hp - damage
+            if self.current_hp <= 0:
+                break
+            else:
+                dungeon.num_beaten += 1
+            self.heal()
+        if log:
+            self.log_dungeon(dungeon)
+
+    def run_dungeon_instrumented(self, dungeon, log=True):
+        # run_dungeon with the verbose printing and instrumentation, kept apart so the normal loop never checks for them
+        start = time.perf_counter()
+        compiled = self.world.get_compiled_party(self)
+        encounter_types = self.world.encounter_types
+        roll = self.world.roll_die
+        dungeon.num_encountered = 0
+        dungeon.num_beaten = 0
+        for i in dungeon.encounter_codes:
+            dungeon.num_encountered += 1
             if global_verbose_flag:
-                print('Encountering {} at {} HP'.format(e.encounter_type.name, self.current_hp))
-            e.encounter_type.encounter_func(self)
+                print('Encountering {} at {} HP'.format(encounter_types[i].name, self.current_hp))
+            hp_before = self.current_hp
+            damage = 0
+            for n in compiled.dice[i]:
+                damage = damage + roll(n)
+            damage = (damage - compiled.offsets[i]) * compiled.multipliers[i]
+            if global_verbose_flag and compiled.multipliers[i] == 2:
+                print('POW!')
+            if damage > 0:
+                self.current_hp = self.current_hp - damage
             if global_verbose_flag:
                 print('Remaining HP {}'.format(self.current_hp))
+            if instrumentation is not None:
+                instrumentation.record_encounter(encounter_types[i].name, hp_before - self.current_hp, self.current_hp <= 0)
             if self.current_hp <= 0:
                 break
             else:
-                e.beaten = True
+                dungeon.num_beaten += 1
             self.heal()
+        if instrumentation is not None:
+            instrumentation.record_time('fight', time.perf_counter() - start)
         if log:
+            start = time.perf_counter()
             self.log_dungeon(dungeon)
+            if instrumentation is not None:
+                instrumentation.record_time('logging', time.perf_counter() - start)
 
     def print_self(self):
         print('Party Members:\n')
@@ -119,28 +356,98 @@ class Party():
                   
 
 class Encounter_Type():
+    __slots__ = ['name', 'threat_level', 'species', 'encounter_func', 'index']
+
     def __init__(self, name, threat_level, species, encounter_func):
         self.name = name
         self.threat_level = threat_level
         self.species = species
         self.encounter_func = encounter_func
+        self.index = None # position in world.encounter_types, set by the world
 
 class Encounter():
-    def __init__(self, encounter_type):
-        self.encounter_type = encounter_type
-        self.encountered = False
-        self.beaten = False
+    # a view of one room of a dungeon.  dungeons only store encounter_codes and how far the party got,
+    # and hand these out from Dungeon.encounters when asked.
+    __slots__ = ['encounter_type', 'encountered', 'beaten']
 
+    def __init__(self, encounter_type, encountered=False, beaten=False):
+        self.encounter_type = encounter_type
+        self.encountered = encountered
+        self.beaten = beaten
+
+
+# the dungeon generator's option lists.  they never change, so they are built once here rather than on
+# every Dungeon.  order matters: the same seed must pick the same options as when these were written inline.
+place_names = ( 'Khaz-Gorond', 'Riverfell', 'Limeneth', 'Galoron', 'Cheliax', 'Lemarchand', 'Calantha', 'Almadris', 'Sintharion',
+    'Azmar', 'Icemarch', 'Lakeshore', 'Stormwind', 'Darkflight Pass', 'Stonefell Peak' )
+city_species = ( 'Goblin', 'Orc', 'Undead' )
+city_bosses = {
+    'Goblin' : ( 'Goblin Chieftain', 'Goblin Chieftain', 'Goblins' ),
+    'Orc' : ( 'Orc Warlord', 'Orc Warlord','Orc Warlord','Orc Shaman','Orc Shaman', 'Orcs' ),
+    'Undead' : ( 'Skeletons', 'Zombies', 'Ghosts', 'Ghosts', 'Lich' ),
+}
+city_trap_types = {
+    'Goblin' : ( 'Boulder Trap', 'Snake Pit', 'Poison Needle Trap' ),
+    'Orc' : ( 'Boulder Trap', 'Snake Pit', 'Poison Needle Trap', 'Cursed Altar' ),
+    'Undead' : ( 'Boulder Trap', 'Poison Needle Trap', 'Cursed Altar' ),
+}
+goblin_city_names = ( 'Tunnels', 'Warrens', 'Cave', 'Town', 'Hole', 'Tower', 'Fort' )
+goblin_city_encounters = { # by goblin type
+    '' : ( 'Goblins', 'Goblins', 'Goblins', 'Goblins' ),
+    'Night' : ( 'Goblins', 'Goblins', 'Goblins', 'Goblins', 'Ghosts' ),
+    'Mountain' : ( 'Goblins', 'Goblins', 'Goblins', 'Goblins', 'Wolves', 'Wolves' ),
+}
+orc_city_names = ( 'Keep', 'Cave', 'Town', 'Camp', 'Tower', 'Warcamp', 'Fort' )
+large_orc_city_names = orc_city_names + ( 'City', 'Citadel' )
+orc_city_encounters = { # by (warlord boss, black orcs)
+    (False, False) : ( 'Orcs', 'Orcs', 'Orcs', 'Orcs', 'Wolves', 'Wolves' ),
+    (True, False) : ( 'Orcs', 'Orcs', 'Orcs', 'Orcs', 'Wolves', 'Wolves', 'Orc Shaman' ),
+    (False, True) : ( 'Orcs', 'Orcs', 'Orcs', 'Orcs', 'Wolves', 'Wolves', 'Orc Warlord' ),
+    (True, True) : ( 'Orcs', 'Orcs', 'Orcs', 'Orcs', 'Wolves', 'Wolves', 'Orc Shaman', 'Orc Warlord' ),
+}
+undead_city_names = ( 'Sepulcher', 'Pyramid', 'Mausoleum', 'Ziggurat', 'City', 'Keep' )
+undead_city_encounters = ( 'Skeletons', 'Skeletons', 'Zombies', 'Zombies', 'Ghosts' )
+lair_bosses = ( 'Dragon', 'Basilisk', 'Lich' )
+lair_slaves = ( 'Goblins', 'Orcs', 'Undead' )
+lair_slave_encounters = {
+    'Undead' : ( 'Zombies', 'Skeletons' ),
+    'Goblins' : ( 'Goblins', 'Wolves' ),
+    'Orcs' : ( 'Orcs', 'Wolves' ),
+}
+lair_prefixes = { # by boss
+    'Dragon' : ( 'Ancient', 'Infernal', 'Old', 'Nightmare', 'Dread', 'Sunken' ),
+    'Basilisk' : ( 'Old', 'Nightmare', 'Dread', 'Sunken' ),
+    'Lich' : ( 'Ancient', 'Infernal', 'Old', 'Nightmare', 'Dread', 'Sunken' ),
+}
+lair_suffixes = { # by boss
+    'Dragon' : ( 'Lair', 'Den', 'Cave', 'Maw' ),
+    'Basilisk' : ( 'Lair', 'Den', 'Cave', 'Maw' ),
+    'Lich' : ( 'Lair', 'Den', 'Cave', 'Tomb' ),
+}
+dungeon_base_encounters = ( 'Zombies', 'Skeletons', 'Ghosts' )
+dungeon_extra_encounters = ( ('Goblins', 0.2), ('Orcs', 0.2), ('Wolves', 0.5), ('Dragon', 0.1), ('Lich', 0.1), ('Basilisk', 0.2) )
+dungeon_encounter_pools = {} # which extra encounters are present -> pool, filled in as they come up
+dungeon_prefixes = ( 'Lost', 'Forgotten', 'Abandoned', 'Timeless' )
+dungeon_suffixes = ( 'Temple', 'Dungeon', 'Treasure' )
+dragon_dungeon_suffixes = ( 'Treasure', )
+
+def get_dungeon_encounter_pool(extras_present):
+    if extras_present not in dungeon_encounter_pools:
+        pool = dungeon_base_encounters + tuple([ e[0] for e, present in zip(dungeon_extra_encounters, extras_present) if present ])
+        dungeon_encounter_pools[extras_present] = pool
+    return(dungeon_encounter_pools[extras_present])
 
 class Dungeon():
     def __init__(self, world):
         self.world = world
+        self.name = '' # stays blank if the world is not generating names
 
-        rng = random.random()
-        if rng < 0.35:
+        rng = self.world.rng
+        dungeon_type_rng = rng.random()
+        if dungeon_type_rng < 0.35:
             self.type = 'City'
             self.setup_city()
-        elif rng < 0.7:
+        elif dungeon_type_rng < 0.7:
             self.type = 'Lair'
             self.setup_lair()
         else:
@@ -148,261 +455,1156 @@ class Dungeon():
             self.setup_dungeon()
 
         self.get_encounters_by_name()
-        self.name = self.name + ' of ' + random.choice([
-            'Khaz-Gorond', 'Riverfell', 'Limeneth', 'Galoron', 'Cheliax', 'Lemarchand', 'Calantha', 'Almadris', 'Sintharion',
-            'Azmar', 'Icemarch', 'Lakeshore', 'Stormwind', 'Darkflight Pass', 'Stonefell Peak'
-        ])
+        if self.world.generate_names:
+            self.name = self.name + ' of ' + rng.choice(place_names)
 
     def setup_city(self):
-        self.species = random.choice(['Goblin', 'Orc', 'Undead'])
-        encounter_count = roll_die(4) + roll_die(4)
+        rng = self.world.rng
+        generate_names = self.world.generate_names
+        self.species = rng.choice(city_species)
+        encounter_count = roll_die(4, rng) + roll_die(4, rng)
         trap_count = math.floor(encounter_count / 2.0)
+        boss = rng.choice(city_bosses[self.species])
         if self.species == 'Goblin':
-            boss = random.choice(['Goblin Chieftain', 'Goblin Chieftain', 'Goblins'])
             if encounter_count >= 6:
                 boss = 'Goblin Chieftain'
-            encounters = ['Goblins', 'Goblins', 'Goblins', 'Goblins']
-            self.name = 'Goblin ' + random.choice(['Tunnels', 'Warrens', 'Cave', 'Town', 'Hole', 'Tower', 'Fort'])
-            goblin_type_rng = random.random()
+            if generate_names:
+                self.name = 'Goblin ' + rng.choice(goblin_city_names)
+            goblin_type_rng = rng.random()
             if goblin_type_rng < 0.2:
-                self.name = 'Night ' + self.name
-                encounters.append('Ghosts')
+                goblin_type = 'Night'
             elif goblin_type_rng < 0.4:
-                self.name = 'Mountain ' + self.name
-                encounters.append('Wolves')
-                encounters.append('Wolves')
-            trap_type = random.choice(['Boulder Trap', 'Snake Pit', 'Poison Needle Trap'])
+                goblin_type = 'Mountain'
+            else:
+                goblin_type = ''
+            if generate_names and goblin_type != '':
+                self.name = goblin_type + ' ' + self.name
+            encounters = goblin_city_encounters[goblin_type]
         elif self.species == 'Orc':
-            boss = random.choice(['Orc Warlord', 'Orc Warlord','Orc Warlord','Orc Shaman','Orc Shaman', 'Orcs'])
-            encounters = ['Orcs', 'Orcs', 'Orcs', 'Orcs', 'Wolves', 'Wolves']
-            name_options = ['Keep', 'Cave', 'Town', 'Camp', 'Tower', 'Warcamp', 'Fort']
-            if encounter_count >= 6:
-                name_options.append('City')
-                name_options.append('Citadel')
-            self.name = 'Orc ' + random.choice(name_options)
-            if boss == 'Orc Warlord':
-                encounters.append('Orc Shaman')
-            if random.random() < 0.2:
+            if generate_names:
+                self.name = 'Orc ' + rng.choice(large_orc_city_names if encounter_count >= 6 else orc_city_names)
+            black_orcs = rng.random() < 0.2
+            if generate_names and black_orcs:
                 self.name = 'Black ' + self.name
-                encounters.append('Orc Warlord')
-            trap_type = random.choice(['Boulder Trap', 'Snake Pit', 'Poison Needle Trap', 'Cursed Altar'])
+            encounters = orc_city_encounters[(boss == 'Orc Warlord', black_orcs)]
         elif self.species == 'Undead':
-            boss = random.choice(['Skeletons', 'Zombies', 'Ghosts', 'Ghosts', 'Lich'])
-            encounters = [ 'Skeletons', 'Skeletons', 'Zombies', 'Zombies', 'Ghosts' ]
-            self.name = 'Undead ' + random.choice(['Sepulcher', 'Pyramid', 'Mausoleum', 'Ziggurat', 'City', 'Keep'])
-            trap_type = random.choice(['Boulder Trap', 'Poison Needle Trap', 'Cursed Altar'])
+            encounters = undead_city_encounters
+            if generate_names:
+                self.name = 'Undead ' + rng.choice(undead_city_names)
+        trap_type = rng.choice(city_trap_types[self.species])
 
         self.encounter_names = []
         while encounter_count > 1: # save one for the boss
-            self.encounter_names.append(random.choice(encounters))
+            self.encounter_names.append(rng.choice(encounters))
             encounter_count = encounter_count - 1
         
         while trap_count > 0: 
             self.encounter_names.append(trap_type)
             trap_count = trap_count - 1
         
-        random.shuffle(self.encounter_names)
+        rng.shuffle(self.encounter_names)
         self.encounter_names.append(boss)       
         
     def setup_lair(self):
-        boss = random.choice(['Dragon', 'Basilisk', 'Lich'])
-        slaves = random.choice(['Goblins', 'Orcs', 'Undead'])
+        rng = self.world.rng
+        boss = rng.choice(lair_bosses)
+        slaves = rng.choice(lair_slaves)
         if boss == 'Lich':
             slaves = 'Undead'
+        slave_encounters = lair_slave_encounters[slaves]
 
-        if slaves == 'Undead':
-            slave_encounters = ['Zombies', 'Skeletons']
-        elif slaves == 'Goblins':
-            slave_encounters = [ 'Goblins', 'Wolves' ]
-        elif slaves == 'Orcs':
-            slave_encounters = [ 'Orcs', 'Wolves' ]
-
-        slave_encounter_count = roll_die(3)
-        trap_count = roll_die(3)
-
-        prefixes = [ 'Ancient', 'Infernal', 'Old', 'Nightmare', 'Dread', 'Sunken' ]
-        suffixes = [ 'Lair', 'Den', 'Cave', 'Maw' ]
-        if boss == 'Lich':
-            suffixes.remove('Maw')
-            suffixes.append('Tomb')
-        if boss == 'Basilisk':
-            prefixes.remove('Ancient')
-            prefixes.remove('Infernal')
+        slave_encounter_count = roll_die(3, rng)
+        trap_count = roll_die(3, rng)
 
-        self.name = random.choice(prefixes) + ' ' + random.choice(suffixes)
+        if self.world.generate_names:
+            self.name = rng.choice(lair_prefixes[boss]) + ' ' + rng.choice(lair_suffixes[boss])
         
         self.encounter_names = []
         while slave_encounter_count > 0: 
-            self.encounter_names.append(random.choice(slave_encounters))
+            self.encounter_names.append(rng.choice(slave_encounters))
             slave_encounter_count = slave_encounter_count - 1
 
-        trap_types = [ e_type.name for e_type in self.world.encounter_types if e_type.species == 'Trap' ]
+        trap_types = self.world.trap_type_names
         while trap_count > 0:
-            self.encounter_names.append(random.choice(trap_types))
+            self.encounter_names.append(rng.choice(trap_types))
             trap_count = trap_count - 1
         
-        random.shuffle(self.encounter_names)
+        rng.shuffle(self.encounter_names)
         self.encounter_names.append(boss)
         
             
     def setup_dungeon(self):
-        encounter_count = roll_die(4)
-        trap_count = roll_die(3) + roll_die(3)
-        encounters = [ 'Zombies', 'Skeletons', 'Ghosts' ]
-        if random.random() < 0.2:
-            encounters.append('Goblins')
-        if random.random() < 0.2:
-            encounters.append('Orcs')
-        if random.random() < 0.5:
-            encounters.append('Wolves')
-        if random.random() < 0.1:
-            encounters.append('Dragon')
-        if random.random() < 0.1:
-            encounters.append('Lich')
-        if random.random() < 0.2:
-            encounters.append('Basilisk')
+        rng = self.world.rng
+        encounter_count = roll_die(4, rng)
+        trap_count = roll_die(3, rng) + roll_die(3, rng)
+        encounters = get_dungeon_encounter_pool(tuple([ rng.random() < e[1] for e in dungeon_extra_encounters ]))
 
         self.encounter_names = []
         while encounter_count > 0: 
-            self.encounter_names.append(random.choice(encounters))
+            self.encounter_names.append(rng.choice(encounters))
             encounter_count = encounter_count - 1
-        trap_types = [ e_type.name for e_type in self.world.encounter_types if e_type.species == 'Trap' ]
+        trap_types = self.world.trap_type_names
         while trap_count > 0:
-            self.encounter_names.append(random.choice(trap_types))
+            self.encounter_names.append(rng.choice(trap_types))
             trap_count = trap_count - 1
 
-        prefixes = [ 'Lost', 'Forgotten', 'Abandoned', 'Timeless' ]
-        suffixes = [ 'Temple', 'Dungeon', 'Treasure' ]
-        if 'Dragon' in encounters:
-            suffixes = ['Treasure']
-
-        self.name = random.choice(prefixes) + ' ' + random.choice(suffixes)
+        if self.world.generate_names:
+            self.name = rng.choice(dungeon_prefixes) + ' ' + rng.choice(dragon_dungeon_suffixes if 'Dragon' in encounters else dungeon_suffixes)
 
-        random.shuffle(self.encounter_names)
+        rng.shuffle(self.encounter_names)
 
     def get_encounters_by_name(self):
-        self.encounters = []
+        encounter_types_by_name = self.world.encounter_types_by_name
+        self.encounter_codes = []
         for e_name in self.encounter_names:
-            encounter_types = [ e_type for e_type in self.world.encounter_types if e_type.name == e_name ]
-            if len(encounter_types) != 1:
-                print('PROBLEM ENCOUNTERED: {} results found querying for {}!\n'.format(len(encounter_types), e_name))
-            self.encounters.append(Encounter(encounter_types[0]))
+            if e_name not in encounter_types_by_name:
+                print('PROBLEM ENCOUNTERED: 0 results found querying for {}!\n'.format(e_name))
+            self.encounter_codes.append(encounter_types_by_name[e_name].index)
+        self.num_encountered = 0
+        self.num_beaten = 0
+
+    @property
+    def encounters(self):
+        encounter_types = self.world.encounter_types
+        return([ Encounter(encounter_types[code], i < self.num_encountered, i < self.num_beaten) for i, code in enumerate(self.encounter_codes) ])
 
     def get_threat_level(self):
-        total_damage = sum([e.encounter_type.threat_level for e in self.encounters])
+        encounter_types = self.world.encounter_types
+        total_damage = sum([encounter_types[i].threat_level for i in self.encounter_codes])
         return((total_damage-1) / self.world.party_size)
 
     def print_self(self):
         print('\n{}:\n'.format(self.name))
         print(self.encounter_names)
         print('\nThreat Level: {}\n'.format(self.get_threat_level()))
-        
 
-
-def encounter_enemy(party, damage, attack_types, wild_empathy_works=False, turn_undead_works=False, verbose=False):
-    double_damage = False
-    uncountered_attack_types = [a for a in attack_types if a not in party.guards]
-
-    if wild_empathy_works:
-        damage = damage - party.wild_empathy
-
-    uncountered_type_count = len(uncountered_attack_types)
-    if turn_undead_works and party.healing > 0:
+class Dungeon_Compositions():
+    # how many of each encounter type are in each of a batch of dungeons, without their order or names
+    def __init__(self, world, dungeon_types, encounter_counts):
+        self.dungeon_types = dungeon_types # 0 for City, 1 for Lair, 2 for Dungeon
+        self.encounter_counts = encounter_counts # one row per dungeon, one column per world.encounter_types entry
+        self.num_encounters = encounter_counts.sum(axis=1)
+        threat_levels = np.array([ e_type.threat_level for e_type in world.encounter_types ])
+        self.threat_levels = (encounter_counts @ threat_levels - 1) / world.party_size
+
+def add_pool_draws(world, encounter_counts, rows, draws, pool, rng):
+    # adds draws[i] uniform picks from pool to the encounter counts of dungeon rows[i]
+    if len(rows) == 0:
+        return
+    pvals = np.zeros(len(world.encounter_types))
+    for e_name in pool:
+        pvals[world.encounter_types_by_name[e_name].index] += 1 / len(pool)
+    encounter_counts[rows] += rng.multinomial(draws, pvals)
+
+def add_choice_draws(world, encounter_counts, rows, draws, options, rng):
+    # picks one of options for each dungeon in rows, and adds draws[i] of it (all the same) to dungeon rows[i]
+    codes = np.array([ world.encounter_types_by_name[e_name].index for e_name in options ])
+    chosen = codes[rng.integers(0, len(options), size=len(rows))]
+    np.add.at(encounter_counts, (rows, chosen), draws)
+    return(chosen)
+
+def generate_dungeon_compositions(world, n, rng=None):
+    # draws the encounter counts of n random dungeons at once, with the same distribution as Dungeon() but
+    # none of its per-dungeon Python work.  encounter order and names are not generated.
+    if np is None:
+        raise ImportError('generate_dungeon_compositions requires numpy')
+    if rng is None:
+        rng = np.random.default_rng()
+    encounter_counts = np.zeros((n, len(world.encounter_types)), dtype=np.int64)
+    dungeon_type_rng = rng.random(n)
+    dungeon_types = np.where(dungeon_type_rng < 0.35, 0, np.where(dungeon_type_rng < 0.7, 1, 2))
+    ones = np.ones(n, dtype=np.int64)
+
+    city = np.flatnonzero(dungeon_types == 0)
+    species = rng.integers(0, len(city_species), size=len(city))
+    encounter_count = rng.integers(1, 5, size=len(city)) + rng.integers(1, 5, size=len(city))
+    for species_id, species_name in enumerate(city_species):
+        in_species = species == species_id
+        rows = city[in_species]
+        species_encounter_count = encounter_count[in_species]
+        bosses = add_choice_draws(world, encounter_counts, rows, ones[:len(rows)], city_bosses[species_name], rng)
+        add_choice_draws(world, encounter_counts, rows, species_encounter_count // 2, city_trap_types[species_name], rng)
+        if species_name == 'Goblin':
+            chieftain = world.encounter_types_by_name['Goblin Chieftain'].index
+            large = species_encounter_count >= 6
+            np.add.at(encounter_counts, (rows[large], bosses[large]), -1)
+            encounter_counts[rows[large], chieftain] += 1
+            goblin_type_rng = rng.random(len(rows))
+            goblin_types = [ ('Night', goblin_type_rng < 0.2), ('Mountain', (goblin_type_rng >= 0.2) & (goblin_type_rng < 0.4)), ('', goblin_type_rng >= 0.4) ]
+            for goblin_type, in_type in goblin_types:
+                add_pool_draws(world, encounter_counts, rows[in_type], species_encounter_count[in_type] - 1, goblin_city_encounters[goblin_type], rng)
+        elif species_name == 'Orc':
+            warlord_boss = bosses == world.encounter_types_by_name['Orc Warlord'].index
+            black_orcs = rng.random(len(rows)) < 0.2
+            for key, pool in orc_city_encounters.items():
+                in_pool = (warlord_boss == key[0]) & (black_orcs == key[1])
+                add_pool_draws(world, encounter_counts, rows[in_pool], species_encounter_count[in_pool] - 1, pool, rng)
+        else:
+            add_pool_draws(world, encounter_counts, rows, species_encounter_count - 1, undead_city_encounters, rng)
+
+    lair = np.flatnonzero(dungeon_types == 1)
+    bosses = rng.integers(0, len(lair_bosses), size=len(lair))
+    slaves = rng.integers(0, len(lair_slaves), size=len(lair))
+    slaves[bosses == lair_bosses.index('Lich')] = lair_slaves.index('Undead')
+    boss_codes = np.array([ world.encounter_types_by_name[e_name].index for e_name in lair_bosses ])
+    np.add.at(encounter_counts, (lair, boss_codes[bosses]), 1)
+    slave_encounter_count = rng.integers(1, 4, size=len(lair))
+    for slaves_id, slaves_name in enumerate(lair_slaves):
+        in_slaves = slaves == slaves_id
+        add_pool_draws(world, encounter_counts, lair[in_slaves], slave_encounter_count[in_slaves], lair_slave_encounters[slaves_name], rng)
+    add_pool_draws(world, encounter_counts, lair, rng.integers(1, 4, size=len(lair)), world.trap_type_names, rng)
+
+    dungeon = np.flatnonzero(dungeon_types == 2)
+    encounter_count = rng.integers(1, 5, size=len(dungeon))
+    extras_present = rng.random((len(dungeon), len(dungeon_extra_encounters))) < np.array([ e[1] for e in dungeon_extra_encounters ])
+    pool_ids = extras_present @ (1 << np.arange(len(dungeon_extra_encounters)))
+    for pool_id in np.unique(pool_ids):
+        in_pool = pool_ids == pool_id
+        add_pool_draws(world, encounter_counts, dungeon[in_pool], encounter_count[in_pool], get_dungeon_encounter_pool(tuple(extras_present[in_pool][0])), rng)
+    add_pool_draws(world, encounter_counts, dungeon, rng.integers(1, 4, size=len(dungeon)) + rng.integers(1, 4, size=len(dungeon)), world.trap_type_names, rng)
+
+    return(Dungeon_Compositions(world, dungeon_types, encounter_counts))
+
+
+# every encounter type, in the order the world lists them.  an enemy deals the total of its dice, less the party's
+# wild empathy if wild_empathy_works, doubled unless the party guards against all its attack types (turn undead
+# counts as guarding one of them); a trap deals the total of its dice less the party's best level in counter_class.
+# load_encounter_specs reads a list in this format from JSON, so new encounters need no new code.
+default_encounter_specs = [
+    { 'name' : 'Goblins', 'threat' : 1.3, 'species' : 'Goblin', 'dice' : [3], 'attack_types' : ['Range'] },
+    { 'name' : 'Goblin Chieftain', 'threat' : 3, 'species' : 'Goblin', 'dice' : [4], 'attack_types' : ['Melee'] },
+    { 'name' : 'Wolves', 'threat' : 3, 'species' : 'Beast', 'dice' : [4], 'attack_types' : ['Melee'], 'wild_empathy_works' : True },
+    { 'name' : 'Orcs', 'threat' : 2, 'species' : 'Orc', 'dice' : [4], 'attack_types' : ['Melee'] },
+    { 'name' : 'Orc Warlord', 'threat' : 5, 'species' : 'Orc', 'dice' : [8], 'attack_types' : ['Melee'] },
+    { 'name' : 'Orc Shaman', 'threat' : 3, 'species' : 'Orc', 'dice' : [6], 'attack_types' : ['Magic'] },
+    { 'name' : 'Skeletons', 'threat' : 2, 'species' : 'Undead', 'dice' : [3], 'attack_types' : ['Range', 'Magic'], 'turn_undead_works' : True },
+    { 'name' : 'Zombies', 'threat' : 2, 'species' : 'Undead', 'dice' : [3], 'attack_types' : ['Melee', 'Magic'], 'turn_undead_works' : True },
+    { 'name' : 'Ghosts', 'threat' : 3, 'species' : 'Undead', 'dice' : [4], 'attack_types' : ['Magic'], 'turn_undead_works' : True },
+    { 'name' : 'Basilisk', 'threat' : 5, 'species' : 'Boss', 'dice' : [8], 'attack_types' : ['Melee', 'Magic'], 'wild_empathy_works' : True },
+    { 'name' : 'Lich', 'threat' : 7, 'species' : 'Boss', 'dice' : [10], 'attack_types' : ['Magic'], 'turn_undead_works' : True },
+    { 'name' : 'Dragon', 'threat' : 10, 'species' : 'Boss', 'dice' : [6, 6], 'attack_types' : ['Melee', 'Range', 'Magic'] },
+    { 'name' : 'Boulder Trap', 'threat' : 2, 'species' : 'Trap', 'dice' : [6], 'counter_class' : 'Fighter' },
+    { 'name' : 'Lever Puzzle Room', 'threat' : 2, 'species' : 'Trap', 'dice' : [6], 'counter_class' : 'Ranger' },
+    { 'name' : 'Riddle Door', 'threat' : 2, 'species' : 'Trap', 'dice' : [6], 'counter_class' : 'Mage' },
+    { 'name' : 'Cursed Altar', 'threat' : 2, 'species' : 'Trap', 'dice' : [6], 'counter_class' : 'Cleric' },
+    { 'name' : 'Snake Pit', 'threat' : 2, 'species' : 'Trap', 'dice' : [6], 'counter_class' : 'Druid' },
+    { 'name' : 'Poison Needle Trap', 'threat' : 2, 'species' : 'Trap', 'dice' : [6], 'counter_class' : 'Rogue' },
+]
+encounter_rules = { spec['name'] : spec for spec in default_encounter_specs } # the default world's rules, by name
+
+attack_type_names = [ 'Melee', 'Range', 'Magic' ]
+
+def check_encounter_spec(spec, class_names):
+    for key in ['name', 'threat', 'species', 'dice']:
+        if key not in spec:
+            raise ValueError('Encounter spec {} has no {}'.format(spec.get('name'), key))
+    if len(spec['dice']) == 0 or any([ not isinstance(n, int) or n < 1 for n in spec['dice'] ]):
+        raise ValueError('Encounter {} has bad dice {}'.format(spec['name'], spec['dice']))
+    if 'counter_class' in spec:
+        if spec['counter_class'] not in class_names:
+            raise ValueError('Encounter {} is countered by unknown class {}'.format(spec['name'], spec['counter_class']))
+    elif 'attack_types' in spec:
+        for attack_type in spec['attack_types']:
+            if attack_type not in attack_type_names:
+                raise ValueError('Encounter {} has unknown attack type {}'.format(spec['name'], attack_type))
+    else:
+        raise ValueError('Encounter {} needs attack_types or a counter_class'.format(spec['name']))
+
+def load_encounter_specs(location):
+    # a JSON list of encounter specs, as in default_encounter_specs above, e.g. for World(encounter_specs=...)
+    with open(location) as f:
+        return(json.load(f))
+
+def get_damage_transform(party, rules):
+    # every encounter deals (roll - offset) * multiplier damage to the party, applied only if positive
+    if 'counter_class' in rules:
+        return((party.class_max_levels[rules['counter_class']], 1))
+
+    offset = party.wild_empathy if rules.get('wild_empathy_works', False) else 0
+    uncountered_type_count = len([a for a in rules['attack_types'] if a not in party.guards])
+    if rules.get('turn_undead_works', False) and party.healing > 0:
         uncountered_type_count = uncountered_type_count - 1
-        
-    if uncountered_type_count > 0:
-        if global_verbose_flag:
-            print('POW!')
-        damage = damage * 2
-
-    if damage > 0:
-        party.current_hp = party.current_hp - damage
-
-def encounter_trap(party, damage, counter_class):
-    party_counter_level = party.class_max_levels[counter_class]
-    damage = damage - party_counter_level
-    if damage > 0:
-        party.current_hp = party.current_hp - damage
-    
-def encounter_goblins(party):
-    damage = roll_die(3)
-    encounter_enemy(party, damage, ['Range'])
-
-def encounter_goblin_chief(party):
-    damage = roll_die(4)
-    encounter_enemy(party, damage, ['Melee'])
-    
-def encounter_orcs(party):
-    damage = roll_die(4)
-    encounter_enemy(party, damage, ['Melee'])
-
-def encounter_wolves(party):
-    damage = roll_die(4)
-    encounter_enemy(party, damage, ['Melee'], wild_empathy_works=True)
-
-def encounter_orc_warlord(party):
-    damage = roll_die(8)
-    encounter_enemy(party, damage, ['Melee'])
- 
-def encounter_orc_shaman(party):
-    damage = roll_die(6)
-    encounter_enemy(party, damage, ['Magic'])
-
-def encounter_skeletons(party):
-    damage = roll_die(3)
-    encounter_enemy(party, damage, [ 'Range', 'Magic'], turn_undead_works=True )
-
-def encounter_zombies(party):
-    damage = roll_die(3)
-    encounter_enemy(party, damage, [ 'Melee', 'Magic'], turn_undead_works=True )    
-
-def encounter_ghosts(party):
-    damage = roll_die(4)
-    encounter_enemy(party, damage, [ 'Magic' ], turn_undead_works=True )
-
-def encounter_basilisk(party):
-    damage = roll_die(8)
-    encounter_enemy(party, damage, ['Melee', 'Magic'], wild_empathy_works=True)
-
-def encounter_lich(party):
-    damage = roll_die(10)
-    encounter_enemy(party, damage, ['Magic'], turn_undead_works=True)
-    
-def encounter_dragon(party):
-    damage = roll_die(6) + roll_die(6)
-    encounter_enemy(party, damage, ['Melee', 'Range', 'Magic'])
-    
-def encounter_boulder_trap(party):
-    damage = roll_die(6)
-    encounter_trap(party, damage, 'Fighter')
-
-def encounter_lever_puzzle_room(party):
-    damage = roll_die(6)
-    encounter_trap(party, damage, 'Ranger')
-
-def encounter_riddle_door(party):
-    damage = roll_die(6)
-    encounter_trap(party, damage, 'Mage')
-
-def encounter_cursed_altar(party):
-    damage = roll_die(6)
-    encounter_trap(party, damage, 'Cleric')
-
-def encounter_snake_pit(party):
-    damage = roll_die(6)
-    encounter_trap(party, damage, 'Druid')
-
-def encounter_poison_needle_trap(party):
-    damage = roll_die(6)
-    encounter_trap(party, damage, 'Rogue')
-
+    multiplier = 2 if uncountered_type_count > 0 else 1
+    return((offset, multiplier))
+
+def make_encounter_func(spec):
+    # the encounter function for a spec, for Encounter_Type.encounter_func: one encounter against a party, by the
+    # same get_damage_transform rules and world.roll_die rolls as the compiled tables Party.run_dungeon uses
+    dice = tuple(spec['dice'])
+    def encounter_func(party):
+        offset, multiplier = get_damage_transform(party, spec)
+        damage = 0
+        for n in dice:
+            damage = damage + party.world.roll_die(n)
+        damage = (damage - offset) * multiplier
+        if damage > 0:
+            party.current_hp = party.current_hp - damage
+    return(encounter_func)
+
+class Compiled_Party():
+    # the damage transform of every encounter type against one party, indexed like world.encounter_types,
+    # so running an encounter is just a table lookup and a die roll
+    def __init__(self, world, party):
+        self.dice = []
+        self.offsets = []
+        self.multipliers = []
+        for e_type in world.encounter_types:
+            rules = world.encounter_rules[e_type.name]
+            offset, multiplier = get_damage_transform(party, rules)
+            self.dice.append(tuple(rules['dice']))
+            self.offsets.append(offset)
+            self.multipliers.append(multiplier)
+
+class Batch_Result():
+    def __init__(self, final_hp, defeated_at):
+        self.runs = len(final_hp)
+        self.final_hp = final_hp
+        self.defeated_at = defeated_at # index of the encounter that beat each run, -1 if the run was won
+        self.wins = int((defeated_at == -1).sum())
+
+    def win_rate(self):
+        return(self.wins / self.runs)
+
+def draw_dungeon_rolls(encounter_names, runs, rng=None, rules=encounter_rules):
+    # the raw dice totals for each encounter in turn, one array of `runs` per encounter.  running several parties
+    # on the same rolls (common random numbers) makes the differences between them far less noisy.
+    if np is None:
+        raise ImportError('draw_dungeon_rolls requires numpy')
+    if rng is None:
+        rng = np.random.default_rng()
+    rolls = []
+    for e_name in encounter_names:
+        total = np.zeros(runs, dtype=np.int64)
+        for n in rules[e_name]['dice']:
+            total += rng.integers(1, n + 1, size=runs)
+        rolls.append(total)
+    return(rolls)
+
+def run_parties_batch(parties, encounter_names, rolls, runs):
+    # runs every party through the encounter list on the same pre-drawn rolls, as one (parties x runs) array
+    # per encounter.  returns (final_hp, defeated_at), both (parties x runs).  runs is passed in rather than
+    # taken from the rolls, since an empty encounter list has no rolls.
+    if any([ len(r) != runs for r in rolls ]):
+        raise ValueError('rolls must hold {} runs for every encounter'.format(runs))
+    rules_by_name = parties[0].world.encounter_rules
+    total_hp = np.array([ float(p.total_hp) for p in parties ])[:, None]
+    healing = np.array([ p.healing for p in parties ])[:, None]
+    hp = np.repeat(total_hp, runs, axis=1)
+    alive = np.ones((len(parties), runs), dtype=bool)
+    defeated_at = np.full((len(parties), runs), -1, dtype=np.int64)
+    for i, e_name in enumerate(encounter_names):
+        rules = rules_by_name[e_name]
+        transforms = [ get_damage_transform(p, rules) for p in parties ]
+        offsets = np.array([ t[0] for t in transforms ])[:, None]
+        multipliers = np.array([ t[1] for t in transforms ])[:, None]
+        damage = (rolls[i][None, :] - offsets) * multipliers
+        hp = np.where(alive & (damage > 0), hp - damage, hp)
+        beaten_here = alive & (hp <= 0)
+        defeated_at[beaten_here] = i
+        alive = alive & ~beaten_here
+        hp = np.where(alive, np.minimum(total_hp, hp + healing), hp)
+    return((hp, defeated_at))
+
+def run_dungeon_batch(party, encounter_names, runs, rng=None, rolls=None):
+    # runs the party through the same encounter list many times, as one numpy array per encounter.
+    # follows the same rules as Party.run_dungeon, but does not touch party.current_hp.
+    if np is None:
+        raise ImportError('run_dungeon_batch requires numpy')
+    if rolls is None:
+        rolls = draw_dungeon_rolls(encounter_names, runs, rng, party.world.encounter_rules)
+    hp, defeated_at = run_parties_batch([party], encounter_names, rolls, runs)
+    return(Batch_Result(hp[0], defeated_at[0]))
+
+def get_party_neighbours(world, string_party, min_level=1, max_level=8):
+    # every party one step away: one adventurer a level up or down, or swapped to another class at the same level
+    neighbours = []
+    seen = set([ tuple(sorted(string_party)) ])
+    for slot, (class_name, level) in enumerate(string_party):
+        changes = [ ('{} {} -> {}'.format(class_name, level, new_level), (class_name, new_level)) for new_level in [level + 1, level - 1] if min_level <= new_level <= max_level ]
+        changes = changes + [ ('{} {} -> {} {}'.format(class_name, level, c.name, level), (c.name, level)) for c in world.char_classes if c.name != class_name ]
+        for label, new_adventurer in changes:
+            new_party = list(string_party)
+            new_party[slot] = new_adventurer
+            key = tuple(sorted(new_party))
+            if key not in seen:
+                seen.add(key)
+                neighbours.append((label, new_party))
+    return(neighbours)
+
+def get_marginal_values(world, string_party, encounter_names, runs=5000, seed=0, min_level=1, max_level=8):
+    # change in win rate for every neighbouring party, all run in one batch on the same rolls as the original.
+    # the standard error is that of the paired per-run differences, so it is small wherever the change only
+    # matters on a few of the runs.  best change first.
+    if np is None:
+        raise ImportError('get_marginal_values requires numpy')
+    neighbours = get_party_neighbours(world, string_party, min_level, max_level)
+    parties = [ world.get_party_by_name_and_levels(string_party) ] + [ world.get_party_by_name_and_levels(n[1]) for n in neighbours ]
+    rolls = draw_dungeon_rolls(encounter_names, runs, np.random.default_rng(seed), world.encounter_rules)
+    won = run_parties_batch(parties, encounter_names, rolls, runs)[1] == -1
+    differences = won[1:].astype(np.float64) - won[0].astype(np.float64)
+    deltas = differences.mean(axis=1)
+    std_errors = differences.std(axis=1, ddof=1) / math.sqrt(runs) if runs > 1 else np.zeros(len(neighbours))
+    base_win_rate = float(won[0].mean())
+    out_list = []
+    for i, (label, new_party) in enumerate(neighbours):
+        out_list.append({ 'change' : label, 'party' : new_party, 'win_rate' : base_win_rate + float(deltas[i]), 'delta' : float(deltas[i]), 'std_error' : float(std_errors[i]) })
+    return({ 'party' : string_party, 'runs' : runs, 'win_rate' : base_win_rate, 'changes' : sorted(out_list, key=lambda struct: struct['delta'], reverse=True) })
+
+dice_distributions = {}
+def get_dice_distribution(dice):
+    # { total : probability } for the sum of the given dice
+    key = tuple(dice)
+    if key not in dice_distributions:
+        distribution = { 0 : 1.0 }
+        for n in dice:
+            new_distribution = {}
+            for total, p in distribution.items():
+                for roll in range(1, n + 1):
+                    new_distribution[total + roll] = new_distribution.get(total + roll, 0) + p / n
+            distribution = new_distribution
+        dice_distributions[key] = distribution
+    return(dice_distributions[key])
+
+def get_damage_distribution(party, rules):
+    # { damage actually taken : probability } for one encounter against this party
+    offset, multiplier = get_damage_transform(party, rules)
+    damage_distribution = {}
+    for roll, p in get_dice_distribution(rules['dice']).items():
+        damage = max(0, (roll - offset) * multiplier)
+        damage_distribution[damage] = damage_distribution.get(damage, 0) + p
+    return(damage_distribution)
+
+class Exact_Result():
+    def __init__(self, win_probability, death_probabilities, final_hp_distribution):
+        self.win_probability = win_probability
+        self.death_probabilities = death_probabilities # chance of being beaten at each encounter in turn
+        self.final_hp_distribution = final_hp_distribution # { hp : probability } over the runs that won
+
+def step_hp_distribution(party, hp_distribution, damage_distribution):
+    # one encounter, then healing.  returns the new { hp : probability } over the runs still alive, and the
+    # probability of being beaten here.
+    new_hp_distribution = {}
+    death_probability = 0
+    for hp, p in hp_distribution.items():
+        for damage, q in damage_distribution.items():
+            remaining_hp = hp - damage
+            if remaining_hp <= 0:
+                death_probability = death_probability + p * q
+            else:
+                remaining_hp = min(party.total_hp, remaining_hp + party.healing)
+                new_hp_distribution[remaining_hp] = new_hp_distribution.get(remaining_hp, 0) + p * q
+    return((new_hp_distribution, death_probability))
+
+def solve_dungeon_exact(party, encounter_names, hp_distribution=None):
+    # pushes the distribution of party HP through the encounter list instead of sampling it.
+    # follows the same rules as Party.run_dungeon.
+    if hp_distribution is None:
+        hp_distribution = { party.total_hp : 1.0 }
+    death_probabilities = []
+    for e_name in encounter_names:
+        hp_distribution, death_probability = step_hp_distribution(party, hp_distribution, get_damage_distribution(party, party.world.encounter_rules[e_name]))
+        death_probabilities.append(death_probability)
+
+    return(Exact_Result(sum(hp_distribution.values()), death_probabilities, hp_distribution))
+
+class Ordering_Result():
+    def __init__(self, orderings):
+        self.orderings = orderings # [ (encounter names, win probability) ] for every distinct ordering, best first
+        self.count = len(orderings)
+        self.best = orderings[0]
+        self.worst = orderings[-1]
+        self.mean_win_probability = sum([ o[1] for o in orderings ]) / len(orderings)
+
+def solve_all_orderings(party, encounter_names, fixed_suffix=[]):
+    # exact win probability of every distinct ordering of the encounter list, followed by fixed_suffix (e.g. a
+    # boss).  walks the trie of distinct orderings depth first, so each shared prefix is stepped through once.
+    # since shuffling makes every distinct ordering equally likely, the mean is the win chance after a shuffle.
+    damage_distributions = { e_name : get_damage_distribution(party, party.world.encounter_rules[e_name]) for e_name in set(encounter_names) | set(fixed_suffix) }
+    remaining = collections.Counter(encounter_names)
+    distinct_names = sorted(remaining.keys())
+    prefix = []
+    orderings = []
+
+    def visit(hp_distribution, rooms_left):
+        if rooms_left == 0:
+            for e_name in fixed_suffix:
+                hp_distribution = step_hp_distribution(party, hp_distribution, damage_distributions[e_name])[0]
+            orderings.append((tuple(prefix) + tuple(fixed_suffix), sum(hp_distribution.values())))
+            return
+        for e_name in distinct_names:
+            if remaining[e_name] == 0:
+                continue
+            remaining[e_name] = remaining[e_name] - 1
+            prefix.append(e_name)
+            visit(step_hp_distribution(party, hp_distribution, damage_distributions[e_name])[0], rooms_left - 1)
+            prefix.pop()
+            remaining[e_name] = remaining[e_name] + 1
+
+    visit({ party.total_hp : 1.0 }, len(encounter_names))
+    orderings.sort(key=lambda o: o[1], reverse=True)
+    return(Ordering_Result(orderings))
+
+def solve_shuffled_dungeon(party, encounter_names, fixed_suffix=[]):
+    # exact win probability when the encounter list is shuffled before fixed_suffix, as Dungeon.setup_city and
+    # setup_lair do with the boss.  the chance of meeting each encounter next depends only on which ones have been
+    # used up, not their order, so this is a DP over sub-multisets: prod(count + 1) states instead of n! orderings.
+    # death_probabilities are by room position, averaged over the shuffle.
+    distinct_names = sorted(set(encounter_names))
+    counts = tuple([ encounter_names.count(e_name) for e_name in distinct_names ])
+    damage_distributions = [ get_damage_distribution(party, party.world.encounter_rules[e_name]) for e_name in distinct_names ]
+    total_rooms = len(encounter_names)
+
+    layer = { tuple([0] * len(counts)) : { party.total_hp : 1.0 } } # used counts -> hp distribution (unnormalized mixture)
+    death_probabilities = []
+    for room in range(total_rooms):
+        new_layer = {}
+        death_probability = 0
+        for used, hp_distribution in layer.items():
+            for i, damage_distribution in enumerate(damage_distributions):
+                if used[i] == counts[i]:
+                    continue
+                weight = (counts[i] - used[i]) / (total_rooms - room)
+                new_hp_distribution, death_here = step_hp_distribution(party, hp_distribution, damage_distribution)
+                death_probability = death_probability + weight * death_here
+                new_used = used[:i] + (used[i] + 1,) + used[i + 1:]
+                merged = new_layer.setdefault(new_used, {})
+                for hp, p in new_hp_distribution.items():
+                    merged[hp] = merged.get(hp, 0) + weight * p
+        death_probabilities.append(death_probability)
+        layer = new_layer
+
+    hp_distribution = layer[counts] if total_rooms > 0 else { party.total_hp : 1.0 }
+    result = solve_dungeon_exact(party, fixed_suffix, hp_distribution)
+    result.death_probabilities = death_probabilities + result.death_probabilities
+    return(result)
+
+def run_test_dungeon(world, string_party, encounter_names, runs):
+    # counts how many of `runs` attempts at the encounter list this party wins, one Party.run_dungeon at a time
+    dungeon = Dungeon(world)
+    dungeon.encounter_names = encounter_names
+    dungeon.get_encounters_by_name()
+    wins = 0
+    for i in range(runs):
+        party = world.get_party_by_name_and_levels(string_party)
+        party.run_dungeon(dungeon, log=False)
+        if party.current_hp > 0:
+            wins = wins + 1
+    return(wins)
+
+def wilson_interval(wins, runs, z=1.96):
+    if runs == 0:
+        return((0.0, 1.0))
+    p = wins / runs
+    centre = (p + z * z / (2 * runs)) / (1 + z * z / runs)
+    half_width = z * math.sqrt(p * (1 - p) / runs + z * z / (4 * runs * runs)) / (1 + z * z / runs)
+    return((max(0.0, centre - half_width), min(1.0, centre + half_width)))
+
+def incomplete_beta(a, b, x):
+    # regularized incomplete beta function I_x(a, b), by Lentz's continued fraction
+    if x <= 0:
+        return(0.0)
+    if x >= 1:
+        return(1.0)
+    if x > (a + 1) / (a + b + 2): # the continued fraction converges quickly only on this side
+        return(1 - incomplete_beta(b, a, 1 - x))
+    log_front = math.lgamma(a + b) - math.lgamma(a) - math.lgamma(b) + a * math.log(x) + b * math.log(1 - x)
+    tiny = 1e-300
+    c = 1.0
+    d = 1 - (a + b) * x / (a + 1)
+    d = 1 / (d if abs(d) > tiny else tiny)
+    fraction = d
+    for m in range(1, 10000):
+        for numerator in [ m * (b - m) * x / ((a + 2 * m - 1) * (a + 2 * m)), -(a + m) * (a + b + m) * x / ((a + 2 * m) * (a + 2 * m + 1)) ]:
+            d = 1 + numerator * d
+            d = 1 / (d if abs(d) > tiny else tiny)
+            c = 1 + numerator / c
+            c = c if abs(c) > tiny else tiny
+            fraction = fraction * c * d
+        if abs(c * d - 1) < 1e-14:
+            break
+    return(math.exp(log_front) * fraction / a)
+
+def beta_quantile(q, a, b):
+    low = 0.0
+    high = 1.0
+    for i in range(100):
+        mid = (low + high) / 2
+        if incomplete_beta(a, b, mid) < q:
+            low = mid
+        else:
+            high = mid
+    return((low + high) / 2)
+
+def clopper_pearson_interval(wins, runs, alpha=0.05):
+    if runs == 0:
+        return((0.0, 1.0))
+    lower = 0.0 if wins == 0 else beta_quantile(alpha / 2, wins, runs - wins + 1)
+    upper = 1.0 if wins == runs else beta_quantile(1 - alpha / 2, wins + 1, runs - wins)
+    return((lower, upper))
+
+def get_confidence_interval(wins, runs, method='wilson'):
+    if method == 'wilson':
+        return(wilson_interval(wins, runs))
+    elif method == 'clopper-pearson':
+        return(clopper_pearson_interval(wins, runs))
+    raise ValueError('Unknown confidence interval method {}'.format(method))
+
+def run_until_confident(world, string_party, encounter_names, target_width=0.01, batch_size=1000, max_runs=50000, method='wilson'):
+    # keeps running batches of trials until the confidence interval on the win rate is narrower than target_width
+    runs = 0
+    wins = 0
+    interval = (0.0, 1.0)
+    while runs < max_runs and interval[1] - interval[0] > target_width:
+        batch_runs = min(batch_size, max_runs - runs)
+        wins = wins + run_test_dungeon(world, string_party, encounter_names, batch_runs)
+        runs = runs + batch_runs
+        interval = get_confidence_interval(wins, runs, method)
+    return({ 'party' : string_party, 'runs' : runs, 'wins' : wins, 'win_rate' : wins / runs, 'interval' : interval })
+
+def race_parties(world, string_parties, encounter_names, top_k=1, target_width=0.01, batch_size=1000, max_runs=50000, method='wilson'):
+    # runs all the parties a batch at a time, and drops a party as soon as its upper confidence bound is below
+    # the lower bound of top_k other parties.  returns every party with the runs it got, best first.
+    entries = [ { 'party' : p, 'runs' : 0, 'wins' : 0, 'win_rate' : 0.0, 'interval' : (0.0, 1.0), 'dominated' : False } for p in string_parties ]
+    racing = entries
+    while len(racing) > top_k:
+        unfinished = [ e for e in racing if e['runs'] < max_runs and e['interval'][1] - e['interval'][0] > target_width ]
+        if len(unfinished) == 0:
+            break
+        for entry in unfinished:
+            batch_runs = min(batch_size, max_runs - entry['runs'])
+            entry['wins'] = entry['wins'] + run_test_dungeon(world, entry['party'], encounter_names, batch_runs)
+            entry['runs'] = entry['runs'] + batch_runs
+            entry['win_rate'] = entry['wins'] / entry['runs']
+            entry['interval'] = get_confidence_interval(entry['wins'], entry['runs'], method)
+        bar = sorted([ e['interval'][0] for e in racing ], reverse=True)[top_k - 1]
+        for entry in racing:
+            if entry['interval'][1] < bar:
+                entry['dominated'] = True
+        racing = [ e for e in racing if e['dominated'] == False ]
+
+    return(sorted(entries, key=lambda struct: struct['win_rate'], reverse=True))
+
+def get_possible_parties(world, min_level=1, max_level=8, max_total_level=None):
+    # every distinct party (multiset of class and level) whose levels add up to at most max_total_level
+    options = [ (c.name, level) for c in world.char_classes for level in range(min_level, max_level + 1) ]
+    possible_parties = []
+    for party in itertools.combinations_with_replacement(options, world.party_size):
+        if max_total_level is None or sum([a[1] for a in party]) <= max_total_level:
+            possible_parties.append(list(party))
+    return(possible_parties)
+
+def search_party_chunk(string_parties, encounter_names, runs, seed, chunk_id):
+    # worker for search_parties.  each chunk gets its own seed stream derived from (seed, chunk_id),
+    # so results do not depend on how many workers there are or which one picks the chunk up.
+    out_list = []
+    if np is not None:
+        world = World(log=False)
+        rng = np.random.default_rng([seed, chunk_id])
+        for string_party in string_parties:
+            party = world.get_party_by_name_and_levels(string_party)
+            result = run_dungeon_batch(party, encounter_names, runs, rng)
+            out_list.append({ 'party' : string_party, 'win_rate' : result.win_rate() })
+    else:
+        world = World(log=False, rng=random.Random('{} {}'.format(seed, chunk_id)))
+        for string_party in string_parties:
+            wins = run_test_dungeon(world, string_party, encounter_names, runs)
+            out_list.append({ 'party' : string_party, 'win_rate' : wins / runs })
+    return(out_list)
+
+def search_parties(encounter_names, runs=1000, top_k=10, min_level=1, max_level=8, max_total_level=None, seed=0, workers=None, chunk_size=500):
+    # runs every possible party through the encounter list across a process pool, and returns the top_k
+    # by win rate, best first
+    import concurrent.futures
+    candidates = get_possible_parties(World(log=False), min_level, max_level, max_total_level)
+    chunks = [ candidates[i:i + chunk_size] for i in range(0, len(candidates), chunk_size) ]
+    best = []
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [ executor.submit(search_party_chunk, chunk, encounter_names, runs, seed, chunk_id) for chunk_id, chunk in enumerate(chunks) ]
+        for future in futures:
+            best = heapq.nlargest(top_k, best + future.result(), key=lambda struct: struct['win_rate'])
+    return(best)
+
+damage_moments = {}
+def get_damage_moments(dice, offset, multiplier):
+    # (mean, variance, { damage : probability }) of the damage one encounter deals, from the exact dice distribution
+    key = (dice, offset, multiplier)
+    if key not in damage_moments:
+        damage_distribution = {}
+        for roll, p in get_dice_distribution(dice).items():
+            damage = max(0, (roll - offset) * multiplier)
+            damage_distribution[damage] = damage_distribution.get(damage, 0) + p
+        mean = sum([ d * p for d, p in damage_distribution.items() ])
+        variance = sum([ (d - mean) * (d - mean) * p for d, p in damage_distribution.items() ])
+        damage_moments[key] = (mean, variance, damage_distribution)
+    return(damage_moments[key])
+
+class Threat_Table():
+    # expected damage, its variance and the chance of a one-room wipe for every encounter type against every party
+    # signature, worked out once from the exact dice distributions.  damage depends only on the signature (and so
+    # on the compiled offsets and multipliers), so many parties share a row, and rows share the moments above.
+    # estimate_win_probability is an O(rooms) normal approximation for screening parties without simulating;
+    # it ignores healing lost to the HP cap, so it is optimistic for long dungeons, but ranks parties well.
+    def __init__(self, world):
+        self.world = world
+        self.rows = {} # party signature -> [ (mean, variance, damage distribution) ] by encounter index
+
+    def get_row(self, party):
+        signature = party.signature
+        if signature not in self.rows:
+            compiled = self.world.get_compiled_party(party)
+            self.rows[signature] = [ get_damage_moments(compiled.dice[i], compiled.offsets[i], compiled.multipliers[i])
+                for i in range(len(self.world.encounter_types)) ]
+        return(self.rows[signature])
+
+    def get_encounter_threat(self, party, e_name):
+        # { expected damage, variance, chance this room alone beats the party from full HP }
+        mean, variance, damage_distribution = self.get_row(party)[self.world.encounter_types_by_name[e_name].index]
+        lethal_probability = sum([ p for d, p in damage_distribution.items() if d >= party.total_hp ])
+        return({ 'expected_damage' : mean, 'variance' : variance, 'lethal_probability' : lethal_probability })
+
+    def get_expected_damage(self, party, encounter_names):
+        row = self.get_row(party)
+        encounter_types_by_name = self.world.encounter_types_by_name
+        return(sum([ row[encounter_types_by_name[e_name].index][0] for e_name in encounter_names ]))
+
+    def estimate_win_probability(self, party, encounter_names):
+        row = self.get_row(party)
+        encounter_types_by_name = self.world.encounter_types_by_name
+        mean = 0
+        variance = 0
+        for e_name in encounter_names:
+            moments = row[encounter_types_by_name[e_name].index]
+            mean = mean + moments[0]
+            variance = variance + moments[1]
+        # the party survives if the total damage is less than its HP plus the healing between rooms
+        margin = party.total_hp + party.healing * (len(encounter_names) - 1) - 0.5 - mean
+        if variance == 0:
+            return(1.0 if margin > 0 else 0.0)
+        return(0.5 * (1 + math.erf(margin / math.sqrt(2 * variance))))
+
+def screen_parties(world, string_parties, encounter_names, shortlist=20, top_k=10, method='exact', runs=10000, seed=0, threat_table=None):
+    # ranks every party by the threat table's estimate, then works out the real win rate of only the best
+    # shortlist of them, exactly or by batch simulation.  returns the top_k of the shortlist, best first.
+    if threat_table is None:
+        threat_table = Threat_Table(world)
+    scored = [ (threat_table.estimate_win_probability(world.get_party_by_name_and_levels(p), encounter_names), p) for p in string_parties ]
+    candidates = heapq.nlargest(shortlist, scored, key=lambda struct: struct[0])
+    if method == 'simulate':
+        rng = np.random.default_rng(seed)
+    out_list = []
+    for estimate, string_party in candidates:
+        party = world.get_party_by_name_and_levels(string_party)
+        if method == 'exact':
+            win_rate = solve_dungeon_exact(party, encounter_names).win_probability
+        elif method == 'simulate':
+            win_rate = run_dungeon_batch(party, encounter_names, runs, rng).win_rate()
+        else:
+            raise ValueError('Unknown screening method {}'.format(method))
+        out_list.append({ 'party' : string_party, 'estimate' : estimate, 'win_rate' : win_rate })
+    return(sorted(out_list, key=lambda struct: struct['win_rate'], reverse=True)[:top_k])
+
+class Result_Cache():
+    # remembers how many runs and wins each (party, encounter list, seed) has had, in memory (least recently used
+    # first out) and in a sqlite file.  the run count is not part of the key: asking for more runs than are cached
+    # only simulates the extra runs, with a seed stream that carries on from the cached ones, and folds them in.
+    def __init__(self, location='dungeon_crawl_cache.sqlite', memory_size=1024):
+        import sqlite3
+        self.memory = collections.OrderedDict() # key -> (runs, wins)
+        self.memory_size = memory_size
+        self.connection = None
+        if location is not None:
+            self.connection = sqlite3.connect(location)
+            self.connection.execute('CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, runs INTEGER, wins INTEGER)')
+
+    def get_key(self, string_party, encounter_names, seed, encounter_specs=default_encounter_specs, method='batch', rng_backend=None):
+        # the specs are hashed in, so worlds with different rules never share results, and so are the simulator and
+        # rng backend, as each gives its own dice for the same seed
+        specs_hash = hashlib.sha256(json.dumps(encounter_specs, sort_keys=True).encode()).hexdigest()
+        canonical = json.dumps({ 'party' : sorted([ [a[0], a[1]] for a in string_party ]), 'encounters' : list(encounter_names), 'seed' : seed, 'specs' : specs_hash,
+            'method' : method, 'rng' : rng_backend })
+        return(hashlib.sha256(canonical.encode()).hexdigest())
+
+    def lookup(self, key):
+        if key in self.memory:
+            self.memory.move_to_end(key)
+            return(self.memory[key])
+        result = (0, 0)
+        if self.connection is not None:
+            row = self.connection.execute('SELECT runs, wins FROM results WHERE key = ?', (key,)).fetchone()
+            if row is not None:
+                result = (row[0], row[1])
+        self.remember(key, result)
+        return(result)
+
+    def remember(self, key, result):
+        self.memory[key] = result
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.memory_size:
+            self.memory.popitem(last=False)
+
+    def store(self, key, runs, wins):
+        self.remember(key, (runs, wins))
+        if self.connection is not None:
+            self.connection.execute('INSERT OR REPLACE INTO results (key, runs, wins) VALUES (?, ?, ?)', (key, runs, wins))
+            self.connection.commit()
+
+    def run_test_dungeon(self, world, string_party, encounter_names, runs, seed=0, method=None, rng_backend='mersenne'):
+        # like run_test_dungeon, but returns { 'runs', 'wins', 'win_rate' } over at least `runs` runs, reusing any
+        # runs already cached.  method is 'batch' (the numpy batch simulator, the default when numpy is available)
+        # or 'simulate' (Party.run_dungeon, rolling with the given rng backend).
+        if method is None:
+            method = 'batch' if np is not None else 'simulate'
+        if method not in ['batch', 'simulate']:
+            raise ValueError('Unknown cached simulation method {}'.format(method))
+        key = self.get_key(string_party, encounter_names, seed, world.encounter_specs, method, rng_backend if method == 'simulate' else None)
+        cached_runs, cached_wins = self.lookup(key)
+        if cached_runs < runs:
+            extra_runs = runs - cached_runs
+            segment_seed = '{} {}'.format(seed, cached_runs) # so topping up the same entry twice never repeats dice
+            if method == 'batch':
+                rng = np.random.default_rng(int(hashlib.sha256(segment_seed.encode()).hexdigest()[:16], 16)) if np is not None else None
+                extra_wins = run_dungeon_batch(world.get_party_by_name_and_levels(string_party), encounter_names, extra_runs, rng).wins
+            else:
+                world_rng = world.rng
+                world.rng = make_rng(segment_seed, rng_backend)
+                try:
+                    extra_wins = run_test_dungeon(world, string_party, encounter_names, extra_runs)
+                finally:
+                    world.rng = world_rng
+            cached_runs = cached_runs + extra_runs
+            cached_wins = cached_wins + extra_wins
+            self.store(key, cached_runs, cached_wins)
+        return({ 'runs' : cached_runs, 'wins' : cached_wins, 'win_rate' : cached_wins / cached_runs })
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
 
 
                    
+class Log_Writer():
+    # keeps one log file open and writes rows to it through csv.writer, a batch of flush_rows at a time
+    def __init__(self, location, overwrite=False, flush_rows=1000):
+        self.location = location
+        self.flush_rows = flush_rows
+        self.file = open(location, 'w' if overwrite else 'a', newline='')
+        self.writer = csv.writer(self.file, lineterminator='\n')
+        self.rows = []
+
+    def write_headers(self, headers):
+        self.write(headers)
+
+    def write(self, row):
+        self.rows.append(list(row)) # callers may keep appending to the list they logged
+        if len(self.rows) >= self.flush_rows:
+            self.flush()
+
+    def flush(self):
+        self.writer.writerows(self.rows)
+        self.rows = []
+        self.file.flush()
+
+    def close(self):
+        if self.file is not None:
+            self.flush()
+            self.file.close()
+            self.file = None
+
+    def __enter__(self):
+        return(self)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+class Alias_Table():
+    # Vose's alias method: draws from a fixed discrete distribution with one index and one coin flip
+    def __init__(self, options, weights):
+        n = len(options)
+        total = sum(weights)
+        scaled = [ w * n / total for w in weights ]
+        self.options = options
+        self.probs = [ 1.0 for o in options ]
+        self.aliases = list(range(n))
+        small = [ i for i in range(n) if scaled[i] < 1 ]
+        large = [ i for i in range(n) if scaled[i] >= 1 ]
+        while len(small) and len(large):
+            s = small.pop()
+            l = large.pop()
+            self.probs[s] = scaled[s]
+            self.aliases[s] = l
+            scaled[l] = scaled[l] + scaled[s] - 1
+            if scaled[l] < 1:
+                small.append(l)
+            else:
+                large.append(l)
+
+    def draw(self, rng):
+        i = int(rng.random() * len(self.options))
+        if rng.random() < self.probs[i]:
+            return(self.options[i])
+        return(self.options[self.aliases[i]])
+
+def get_log_column_type(header):
+    if header == 'Threat Level':
+        return(pyarrow.float64())
+    if header in ['Dungeon Name', 'Defeated By'] or header.endswith(' Class') or header.startswith('Encounter '):
+        return(pyarrow.string())
+    return(pyarrow.int16())
+
+class Columnar_Log_Writer():
+    # writes log rows as typed columns to a parquet or arrow ipc file, a record batch of flush_rows at a time.
+    # write_headers sets up the schema and has to come before any rows.  text columns are dictionary encoded
+    # unless dictionary_encode is False, and empty text (e.g. unused encounter slots) is stored as null.
+    def __init__(self, location, file_format='parquet', overwrite=True, flush_rows=1000, dictionary_encode=True):
+        if pyarrow is None:
+            raise ImportError('{} logs require pyarrow'.format(file_format))
+        if overwrite == False:
+            raise ValueError('{} logs cannot be appended to'.format(file_format))
+        self.location = location
+        self.file_format = file_format
+        self.flush_rows = flush_rows
+        self.dictionary_encode = dictionary_encode
+        self.schema = None
+        self.file_writer = None
+        self.dictionaries = {} # column -> { value : index }, only ever appended to so arrow can write deltas
+        self.rows = []
+
+    def write_headers(self, headers):
+        fields = []
+        for header in headers:
+            column_type = get_log_column_type(header)
+            if column_type == pyarrow.string() and self.dictionary_encode:
+                column_type = pyarrow.dictionary(pyarrow.int32(), pyarrow.string())
+                self.dictionaries[header] = {}
+            fields.append(pyarrow.field(header, column_type))
+        self.schema = pyarrow.schema(fields)
+        if self.file_format == 'parquet':
+            self.file_writer = pyarrow.parquet.ParquetWriter(self.location, self.schema)
+        elif self.file_format == 'arrow':
+            options = pyarrow.ipc.IpcWriteOptions(emit_dictionary_deltas=True)
+            self.file_writer = pyarrow.ipc.new_file(self.location, self.schema, options=options)
+        else:
+            raise ValueError('Unknown log format {}'.format(self.file_format))
+
+    def write(self, row):
+        if self.schema is None:
+            raise ValueError('{} has no headers yet, so cannot take rows'.format(self.location))
+        self.rows.append(list(row))
+        if len(self.rows) >= self.flush_rows:
+            self.flush()
+
+    def get_column(self, i, field):
+        values = [ r[i] for r in self.rows ]
+        if field.name in self.dictionaries:
+            dictionary = self.dictionaries[field.name]
+            indices = []
+            for v in values:
+                if v == '':
+                    indices.append(None)
+                else:
+                    if v not in dictionary:
+                        dictionary[v] = len(dictionary)
+                    indices.append(dictionary[v])
+            return(pyarrow.DictionaryArray.from_arrays(pyarrow.array(indices, type=pyarrow.int32()), pyarrow.array(list(dictionary.keys()), type=pyarrow.string())))
+        if field.type == pyarrow.string():
+            values = [ None if v == '' else v for v in values ]
+        return(pyarrow.array(values, type=field.type))
+
+    def flush(self):
+        if self.file_writer is None or len(self.rows) == 0:
+            return
+        columns = [ self.get_column(i, field) for i, field in enumerate(self.schema) ]
+        self.file_writer.write_batch(pyarrow.record_batch(columns, schema=self.schema))
+        self.rows = []
+
+    def close(self):
+        if self.file_writer is not None:
+            self.flush()
+            self.file_writer.close()
+            self.file_writer = None
+
+    def __enter__(self):
+        return(self)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+def read_columnar_log(location):
+    # loads a parquet or arrow log written by Columnar_Log_Writer as a pyarrow Table
+    if pyarrow is None:
+        raise ImportError('reading columnar logs requires pyarrow')
+    if location.endswith('.parquet'):
+        return(pyarrow.parquet.read_table(location))
+    with pyarrow.ipc.open_file(location) as reader:
+        return(reader.read_all())
+
+binary_log_magic = b'DUNGEON CRAWL LOG 1\n'
+
+def get_binary_log_dtype(party_size, max_dungeon_length, name_width):
+    return(np.dtype([ ('name', 'S{}'.format(name_width)), ('classes', 'i1', (party_size,)), ('levels', 'u1', (party_size,)),
+        ('encounters', 'i1', (max_dungeon_length,)), ('threat_level', 'f8'), ('num_encounters', 'u1'), ('num_beaten', 'u1'),
+        ('victory', 'u1'), ('defeated_by', 'i1') ]))
+
+class Binary_Log_Writer():
+    # writes log rows as fixed-width numpy records: classes and encounters as indices into the world's lists, -1 for
+    # an empty encounter slot or no defeat.  the file starts with binary_log_magic and a line of JSON giving the
+    # class and encounter names and the record layout, then the records, so read_binary_log can memmap them.
+    # takes the same rows as Log_Writer; extended log columns are ignored, since they can all be worked out from
+    # the rest, and so are the header names, as the file header is written from the metadata.  dungeon names
+    # longer than name_width bytes are cut short.
+    def __init__(self, location, char_class_names, encounter_type_names, party_size=4, max_dungeon_length=12, overwrite=True, flush_rows=1000, name_width=48):
+        if np is None:
+            raise ImportError('binary logs require numpy')
+        self.location = location
+        self.overwrite = overwrite
+        self.flush_rows = flush_rows
+        self.metadata = { 'classes' : list(char_class_names), 'encounters' : list(encounter_type_names), 'party_size' : party_size,
+            'max_dungeon_length' : max_dungeon_length, 'name_width' : name_width }
+        self.dtype = get_binary_log_dtype(party_size, max_dungeon_length, name_width)
+        self.class_codes = { name : i for i, name in enumerate(char_class_names) }
+        self.encounter_codes = { name : i for i, name in enumerate(encounter_type_names) }
+        self.encounter_codes[''] = -1
+        self.started = False
+        self.rows = []
+
+    def start(self):
+        if self.overwrite == False and os.path.exists(self.location) and os.path.getsize(self.location) > 0:
+            if read_binary_log_metadata(self.location)[0] != self.metadata:
+                raise ValueError('{} was written with different classes, encounters or layout'.format(self.location))
+        else:
+            with open(self.location, 'wb') as f:
+                f.write(binary_log_magic + (json.dumps(self.metadata) + '\n').encode())
+        self.started = True
+
+    def write_headers(self, headers):
+        self.start()
+
+    def write(self, row):
+        if self.started == False:
+            self.start()
+        party_size = self.metadata['party_size']
+        max_dungeon_length = self.metadata['max_dungeon_length']
+        encounters_end = 1 + 2 * party_size + max_dungeon_length
+        self.rows.append((row[0].encode(), [ self.class_codes[c] for c in row[1:1 + 2 * party_size:2] ], row[2:1 + 2 * party_size:2],
+            [ self.encounter_codes[e] for e in row[1 + 2 * party_size:encounters_end] ], row[encounters_end], row[encounters_end + 1],
+            row[encounters_end + 2], row[encounters_end + 3], self.encounter_codes[row[encounters_end + 4]]))
+        if len(self.rows) >= self.flush_rows:
+            self.flush()
+
+    def flush(self):
+        if len(self.rows) == 0:
+            return
+        with open(self.location, 'ab') as f:
+            np.array(self.rows, dtype=self.dtype).tofile(f)
+        self.rows = []
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return(self)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+def read_binary_log_metadata(location):
+    # (metadata, offset of the first record)
+    with open(location, 'rb') as f:
+        if f.readline() != binary_log_magic:
+            raise ValueError('{} is not a binary dungeon log'.format(location))
+        metadata_line = f.readline()
+    return((json.loads(metadata_line), len(binary_log_magic) + len(metadata_line)))
+
+def read_binary_log(location, mode='r'):
+    # (records, metadata) for a Binary_Log_Writer file.  records is a read-only np.memmap of the structured dtype,
+    # so it loads instantly and can be sliced and filtered in place, e.g.
+    #   records[records['threat_level'] > 5]['victory'].mean()
+    # and metadata['classes'] / metadata['encounters'] turn the codes back into names.
+    if np is None:
+        raise ImportError('reading binary logs requires numpy')
+    metadata, offset = read_binary_log_metadata(location)
+    dtype = get_binary_log_dtype(metadata['party_size'], metadata['max_dungeon_length'], metadata['name_width'])
+    count = (os.path.getsize(location) - offset) // dtype.itemsize # a half-written last record is left off
+    if count == 0:
+        return((np.zeros(0, dtype=dtype), metadata))
+    return((np.memmap(location, dtype=dtype, mode=mode, offset=offset, shape=(count,)), metadata))
+
+def iter_binary_log_rows(location, start=0):
+    # the rows of a binary log from record start on, as extended log { header : value } dicts, for code written
+    # against the csv logs
+    records, metadata = read_binary_log(location)
+    class_names = metadata['classes']
+    encounter_names = metadata['encounters']
+    for record in records[start:]:
+        row = { 'Dungeon Name' : record['name'].decode() }
+        for i in range(metadata['party_size']):
+            row['Adventurer {} Class'.format(i + 1)] = class_names[record['classes'][i]]
+            row['Adventurer {} Level'.format(i + 1)] = int(record['levels'][i])
+        for i in range(metadata['max_dungeon_length']):
+            row['Encounter {}'.format(i + 1)] = encounter_names[record['encounters'][i]] if record['encounters'][i] >= 0 else ''
+        row['Threat Level'] = float(record['threat_level'])
+        row['# Encounters'] = int(record['num_encounters'])
+        row['# Encounters Beaten'] = int(record['num_beaten'])
+        row['Victory?'] = int(record['victory'])
+        row['Defeated By'] = encounter_names[record['defeated_by']] if record['defeated_by'] >= 0 else ''
+        for c, name in enumerate(class_names):
+            levels = [ int(record['levels'][i]) for i in range(metadata['party_size']) if record['classes'][i] == c ]
+            row['# of {} Adventurers'.format(name)] = len(levels)
+            row['Total Level of {} Adventurers'.format(name)] = sum([0] + levels)
+            row['Max Level of {} Adventurers'.format(name)] = max([0] + levels)
+        encounter_counts = np.bincount(record['encounters'][record['encounters'] >= 0], minlength=len(encounter_names))
+        for e, name in enumerate(encounter_names):
+            row['# of {} Encounters'.format(name)] = int(encounter_counts[e])
+        yield(row)
+
+def iter_log_rows(location):
+    # yields the rows of a log one at a time as { header : value } dicts, without loading the whole file
+    if location.endswith('.bin'):
+        for row in iter_binary_log_rows(location):
+            yield(row)
+    elif location.endswith('.parquet') or location.endswith('.arrow'):
+        if pyarrow is None:
+            raise ImportError('reading columnar logs requires pyarrow')
+        if location.endswith('.parquet'):
+            batches = pyarrow.parquet.ParquetFile(location).iter_batches()
+        else:
+            reader = pyarrow.ipc.open_file(location)
+            batches = ( reader.get_batch(i) for i in range(reader.num_record_batches) )
+        for batch in batches:
+            for row in batch.to_pylist():
+                yield({ k : ('' if v is None else v) for k, v in row.items() })
+    else:
+        with open(location) as f:
+            for row in csv.DictReader(f, skipinitialspace=True):
+                yield(row)
+
+log_extensions = { 'csv' : '.csv', 'parquet' : '.parquet', 'arrow' : '.arrow', 'binary' : '.bin' }
+
+def close_log_writers(log_writers):
+    # closes every writer in a world's { location : writer } dict and empties it, from World.close_logs or
+    # when the world is garbage collected or the interpreter exits
+    for writer in log_writers.values():
+        writer.close()
+    log_writers.clear()
+
 class World():
-    def __init__(self, log=True):
+    def __init__(self, log=True, log_location=None, extended_log_location=None, log_flush_rows=1000, log_format='csv', log_dictionary_encode=True, rng=None, direct_adventurer_sampling=False, generate_names=True, encounter_specs=None):
+        self.rng = rng if rng is not None else random # anything with random/choice/shuffle, e.g. make_rng(seed, 'block')
+        self.generate_names = generate_names # dungeon names use up random draws, so turning them off changes seeded runs
+        self.direct_adventurer_sampling = direct_adventurer_sampling
+        self.adventurer_alias_tables = {} # (threat level, count of each class already in the party) -> Alias_Table
         self.party_size = 4
         self.max_dungeon_length = 12
+        if log == False and log_format in ['parquet', 'arrow']:
+            raise ValueError('{} logs cannot be appended to, so need log=True'.format(log_format))
+        self.log_format = log_format
+        self.log_location = log_location if log_location is not None else 'dungeon_crawl' + log_extensions[log_format]
+        self.extended_log_location = extended_log_location if extended_log_location is not None else 'dungeon_crawl_corrected' + log_extensions[log_format]
+        self.log_flush_rows = log_flush_rows
+        self.log_dictionary_encode = log_dictionary_encode
+        self.log_writers = {} # log location -> Log_Writer
+        weakref.finalize(self, close_log_writers, self.log_writers) # buffered rows still get written if nobody calls close_logs
         self.char_classes = [
             Char_Class('Fighter', True, False, False, False, False, False ),
             Char_Class('Ranger', False, True, False, False, False, False ),
@@ -411,61 +1613,139 @@ class World():
             Char_Class('Druid', False, False, False, False, True, False ),
             Char_Class('Rogue', False, False, False, False, False, True ),
             ]
-        self.encounter_types = [
-            Encounter_Type('Goblins', 1.3, 'Goblin', encounter_goblins),
-            Encounter_Type('Goblin Chieftain', 3, 'Goblin', encounter_goblin_chief),
-            Encounter_Type('Wolves', 3, 'Beast', encounter_wolves),
-            Encounter_Type('Orcs', 2, 'Orc', encounter_orcs),
-            Encounter_Type('Orc Warlord', 5, 'Orc', encounter_orc_warlord),
-            Encounter_Type('Orc Shaman', 3, 'Orc', encounter_orc_shaman),
-            Encounter_Type('Skeletons', 2, 'Undead', encounter_skeletons),
-            Encounter_Type('Zombies', 2, 'Undead', encounter_zombies),
-            Encounter_Type('Ghosts', 3, 'Undead', encounter_ghosts),
-            Encounter_Type('Basilisk', 5, 'Boss', encounter_basilisk),
-            Encounter_Type('Lich', 7, 'Boss', encounter_lich),
-            Encounter_Type('Dragon', 10, 'Boss', encounter_dragon),
-            Encounter_Type('Boulder Trap', 2, 'Trap', encounter_boulder_trap),
-            Encounter_Type('Lever Puzzle Room', 2, 'Trap', encounter_lever_puzzle_room),
-            Encounter_Type('Riddle Door', 2, 'Trap', encounter_riddle_door),
-            Encounter_Type('Cursed Altar', 2, 'Trap', encounter_cursed_altar),
-            Encounter_Type('Snake Pit', 2, 'Trap', encounter_snake_pit),
-            Encounter_Type('Poison Needle Trap', 2, 'Trap', encounter_poison_needle_trap),
-        ]
+        self.encounter_specs = encounter_specs if encounter_specs is not None else default_encounter_specs
+        for spec in self.encounter_specs:
+            check_encounter_spec(spec, [ c.name for c in self.char_classes ])
+        self.encounter_rules = { spec['name'] : spec for spec in self.encounter_specs }
+        self.encounter_types = [ Encounter_Type(spec['name'], spec['threat'], spec['species'], make_encounter_func(spec)) for spec in self.encounter_specs ]
+        for i, e_type in enumerate(self.encounter_types):
+            e_type.index = i
+        self.setup_registries()
+        self.compiled_parties = {} # party signature -> Compiled_Party
+        self.adventurers_by_name_and_level = {}
+        self.party_templates = {} # sorted (class, level) pairs -> Party
+        self.extended_log_headers = self.get_extended_log_headers()
+        self.log_listeners = [] # things with an add_row method, e.g. Dungeon_Stats, that see every extended log row
         if log:
             self.setup_logs()
 
+    @property
+    def rng(self):
+        return(self.current_rng)
+
+    @rng.setter
+    def rng(self, rng):
+        self.current_rng = rng
+        self.roll_die = get_die_roller(rng)
+
+    def setup_registries(self):
+        # lookups by name and species, so building dungeons and parties does not rescan the lists above
+        self.char_classes_by_name = { c.name : c for c in self.char_classes }
+        self.encounter_types_by_name = { e_type.name : e_type for e_type in self.encounter_types }
+        assert(len(self.char_classes_by_name) == len(self.char_classes))
+        assert(len(self.encounter_types_by_name) == len(self.encounter_types))
+        self.encounter_types_by_species = {}
+        for e_type in self.encounter_types:
+            self.encounter_types_by_species.setdefault(e_type.species, []).append(e_type)
+        self.trap_type_names = [ e_type.name for e_type in self.encounter_types_by_species.get('Trap', []) ]
+
+    def get_compiled_party(self, party):
+        signature = party.signature
+        if signature not in self.compiled_parties:
+            self.compiled_parties[signature] = Compiled_Party(self, party)
+        return(self.compiled_parties[signature])
+
+    def get_accept_prob(self, char_class, level, dungeon_threat_level):
+        level_diff = abs(level - dungeon_threat_level)
+        if char_class.cowardly: # favor low-level dungeons
+            if level > dungeon_threat_level:
+                level_diff = level_diff / 2
+            else:
+                level_diff = level_diff * 2
+        return(1 - (0.5 * level_diff)) # favor chars of the right level
+
     def choose_adventurers(self, dungeon):
+        if self.direct_adventurer_sampling:
+            return(self.choose_adventurers_direct(dungeon))
         party = []
         dungeon_threat_level = dungeon.get_threat_level()
         assert(dungeon_threat_level < 10) # if not we will not be able to get chars
         while len(party) < self.party_size:
-            new_char_class = random.choice(self.char_classes)
-            new_char_level = min(roll_die(8), roll_die(8))
-            level_diff = abs(new_char_level - dungeon_threat_level)
-            if new_char_class.cowardly: # favor low-level dungeons
-                if new_char_level > dungeon_threat_level:
-                    level_diff = level_diff / 2
-                else:
-                    level_diff = level_diff * 2
-                
-            accept_prob = 1 - (0.5 * level_diff) # favor chars of the right level
+            new_char_class = self.rng.choice(self.char_classes)
+            new_char_level = min(roll_die(8, self.rng), roll_die(8, self.rng))
+            accept_prob = self.get_accept_prob(new_char_class, new_char_level, dungeon_threat_level)
             for c in party:
                 if c.char_class == new_char_class:
                     accept_prob = 0.5 * accept_prob # favor chars we don't already have
-            if random.random() < accept_prob:
+            if self.rng.random() < accept_prob:
                 party.append(Adventurer(new_char_class, new_char_level))
 
         return(Party(self,party))
-            
+
+    def get_adventurer_alias_table(self, dungeon_threat_level, class_counts):
+        # the distribution choose_adventurers accepts (class, level) from, given how many of each class
+        # the party already has: class uniform, level min(d8, d8), weighted by the acceptance chance
+        key = (dungeon_threat_level, class_counts)
+        if key not in self.adventurer_alias_tables:
+            options = []
+            weights = []
+            for char_class, class_count in zip(self.char_classes, class_counts):
+                for level in range(1, 9):
+                    level_prob = (17 - 2 * level) / 64 # chance that min(d8, d8) == level
+                    accept_prob = self.get_accept_prob(char_class, level, dungeon_threat_level) * (0.5 ** class_count)
+                    if accept_prob > 0:
+                        options.append((char_class, level))
+                        weights.append(level_prob * min(1, accept_prob))
+            if len(options) == 0:
+                raise ValueError('No adventurers will enter a dungeon of threat level {}'.format(dungeon_threat_level))
+            self.adventurer_alias_tables[key] = Alias_Table(options, weights)
+        return(self.adventurer_alias_tables[key])
+
+    def choose_adventurers_direct(self, dungeon):
+        # same party distribution as choose_adventurers, but draws each adventurer straight from a cached
+        # alias table instead of by rejection.  uses the rng differently, so seeded runs will not match.
+        party = []
+        dungeon_threat_level = dungeon.get_threat_level()
+        class_counts = [ 0 for c in self.char_classes ]
+        while len(party) < self.party_size:
+            char_class, level = self.get_adventurer_alias_table(dungeon_threat_level, tuple(class_counts)).draw(self.rng)
+            party.append(Adventurer(char_class, level))
+            class_counts[self.char_classes.index(char_class)] += 1
+
+        return(Party(self,party))
+
+    def get_log_writer(self, extended_log=False, overwrite=False):
+        # the writer for the log or extended log, opened on first use, or reopened from the top if overwrite
+        if extended_log and self.log_format == 'binary': # the binary log already holds everything the extended log would
+            return(None)
+        log_location = self.extended_log_location if extended_log else self.log_location
+        if overwrite or log_location not in self.log_writers:
+            if log_location in self.log_writers:
+                self.log_writers[log_location].close()
+            if self.log_format == 'csv':
+                self.log_writers[log_location] = Log_Writer(log_location, overwrite, self.log_flush_rows)
+            elif self.log_format == 'binary':
+                self.log_writers[log_location] = Binary_Log_Writer(log_location, [ c.name for c in self.char_classes ], [ e_type.name for e_type in self.encounter_types ],
+                    self.party_size, self.max_dungeon_length, overwrite, self.log_flush_rows)
+            else:
+                self.log_writers[log_location] = Columnar_Log_Writer(log_location, self.log_format, overwrite, self.log_flush_rows, self.log_dictionary_encode)
+        return(self.log_writers[log_location])
+
     def log(self, contents, extended_log=False, overwrite=False):
-        log_location = 'dungeon_crawl_corrected.csv' if extended_log else 'dungeon_crawl.csv'
-        contents = [str(x) for x in contents]
-        message = ','.join(contents) + '\n'
-        file = open(log_location, 'w' if overwrite else 'a')
-        file.write(message)
-        
+        writer = self.get_log_writer(extended_log, overwrite)
+        if writer is not None:
+            writer.write(contents)
 
-    def setup_logs(self):
+    def close_logs(self):
+        close_log_writers(self.log_writers)
+
+    def __enter__(self):
+        return(self)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close_logs()
+
+    def get_log_headers(self):
         log_headers = ['Dungeon Name']
         for i in range(1, self.party_size + 1):
             log_headers.append('Adventurer {} Class'.format(str(i)))
@@ -473,10 +1753,10 @@ class World():
         for i in range(1, self.max_dungeon_length + 1):
             log_headers.append('Encounter {}'.format(str(i)))
         log_headers = log_headers + [ 'Threat Level', '# Encounters', '# Encounters Beaten', 'Victory?', 'Defeated By']
+        return(log_headers)
 
-        self.log(log_headers, extended_log=False, overwrite=True)
-
-        extended_log_headers = log_headers
+    def get_extended_log_headers(self):
+        extended_log_headers = self.get_log_headers()
         for c in self.char_classes:
             extended_log_headers.append('# of {} Adventurers'.format(c.name))
             extended_log_headers.append('Total Level of {} Adventurers'.format(c.name))
@@ -484,193 +1764,830 @@ class World():
 
         for e_type in self.encounter_types:
             extended_log_headers.append('# of {} Encounters'.format(e_type.name))
+        return(extended_log_headers)
 
-        self.log(extended_log_headers, extended_log=True, overwrite=True)
+    def setup_logs(self):
+        for extended_log, headers in [ (False, self.get_log_headers()), (True, self.extended_log_headers) ]:
+            writer = self.get_log_writer(extended_log, overwrite=True)
+            if writer is not None:
+                writer.write_headers(headers)
+                writer.flush() # the headers go to disk straight away
 
     def get_class_by_name(self, name):
-        return([c for c in self.char_classes if c.name == name][0])
+        return(self.char_classes_by_name[name])
 
     def get_party_by_name_and_levels(self, a_list): # [ ('Cleric', 3), ('Druid', 3), ('Rogue', 3), ('Cleric', 3) ]
-        party = [ Adventurer(self.get_class_by_name(a[0]), a[1]) for a in a_list ]
-        return(Party(self,party))
+        # adventurers are shared between parties, and party stats are worked out once per (class, level) multiset
+        adventurers = []
+        for a in a_list:
+            if (a[0], a[1]) not in self.adventurers_by_name_and_level:
+                self.adventurers_by_name_and_level[(a[0], a[1])] = Adventurer(self.get_class_by_name(a[0]), a[1])
+            adventurers.append(self.adventurers_by_name_and_level[(a[0], a[1])])
+        key = tuple(sorted([ (a[0], a[1]) for a in a_list ]))
+        if key not in self.party_templates:
+            self.party_templates[key] = Party(self, adventurers)
+        return(self.party_templates[key].copy(adventurers))
 
     def run_dungeon(self):
+        if instrumentation is not None:
+            start = time.perf_counter()
         dungeon = Dungeon(self)
+        while dungeon.get_threat_level() >= 10: # nobody would sign up for this, see choose_adventurers
+            dungeon = Dungeon(self)
+        if instrumentation is not None:
+            instrumentation.record_time('dungeon_setup', time.perf_counter() - start)
+            start = time.perf_counter()
         party = self.choose_adventurers(dungeon)
+        if instrumentation is not None:
+            instrumentation.record_time('party_selection', time.perf_counter() - start)
         if global_verbose_flag:
             dungeon.print_self()
             party.print_self()
         party.run_dungeon(dungeon)
 
-random.seed('Dungeon Crawl Stone Soup')
-ad_hoc_test_runs = False
-main_run = False
-specific_team_test_runs = True
-if( specific_team_test_runs == True):
-    my_world = World(log=False)
-    runs = 0
+class Dungeon_Stats():
+    # the main_run summary tables, updated one extended log row at a time so nothing needs holding in memory.
+    # rows can come from iter_log_rows, or live by adding this to world.log_listeners.
+    def __init__(self, world):
+        self.world = world
+        self.runs = 0
+        self.wins = 0
+        self.class_results_struct = {}
+        for char_class in world.char_classes:
+            self.class_results_struct[char_class.name] = {'appearances' : 0, 'wins' : 0, 'losses' : 0, 'total_level' : 0}
+        self.enc_results_struct = {}
+        for e_type in world.encounter_types:
+            self.enc_results_struct[e_type.name] = {'appearances' : 0, 'wins': 0}
+        self.threat_lvl_victory_struct = {}
+        for i in range(1,10):
+            self.threat_lvl_victory_struct[str(i)] = {'appearances' : 0, 'wins' : 0, 'total_party_level' : 0}
+        self.beaten_by_struct = {}
+
+    def add_row(self, entry):
+        win = int(entry['Victory?'])
+        self.runs = self.runs + 1
+        self.wins = self.wins + win
+
+        for char_class in self.world.char_classes:
+            result = self.class_results_struct[char_class.name]
+            num = int(entry['# of {} Adventurers'.format(char_class.name)])
+            result['appearances'] = result['appearances'] + num
+            result['total_level'] = result['total_level'] + int(entry['Total Level of {} Adventurers'.format(char_class.name)])
+            result['wins'] = result['wins'] + (num * win)
+            result['losses'] = result['losses'] + (num * (1-win))
+
+        for e_type in self.world.encounter_types:
+            result = self.enc_results_struct[e_type.name]
+            num = int(entry['# of {} Encounters'.format(e_type.name)])
+            result['appearances'] = result['appearances'] + num
+            result['wins'] = result['wins'] + (num * win)
+
+        threat_lvl = str(math.ceil(float(entry['Threat Level'])))
+        total_party_level = sum([ int(entry['Adventurer {} Level'.format(i)]) for i in range(1, self.world.party_size + 1) ])
+        if threat_lvl not in self.threat_lvl_victory_struct: # threat levels just under 10 round up to 10
+            self.threat_lvl_victory_struct[threat_lvl] = {'appearances' : 0, 'wins' : 0, 'total_party_level' : 0}
+        result = self.threat_lvl_victory_struct[threat_lvl]
+        result['appearances'] = result['appearances'] + 1
+        result['wins'] = result['wins'] + win
+        result['total_party_level'] = result['total_party_level'] + total_party_level
+
+        if entry['Defeated By'] != '':
+            self.beaten_by_struct[entry['Defeated By']] = self.beaten_by_struct.get(entry['Defeated By'], 0) + 1
+
+    def print_self(self):
+        print('{}/ {} runs won in total ({:.2f}%)'.format(self.wins, self.runs, 100 * self.wins / self.runs))
+
+        for char_class in self.world.char_classes:
+            result = self.class_results_struct[char_class.name]
+            print('{}:\n{} appearances.\n{} won ({:.2f}%).\nAverage Level {:.2f}.'.format(char_class.name, result['appearances'], result['wins'], 100*result['wins']/result['appearances'], result['total_level']/result['appearances']))
+
+        for e_type in self.world.encounter_types:
+            result = self.enc_results_struct[e_type.name]
+            print('{}: {} known appearances, of which adventurers won {} ({:.2f}%)'.format(e_type.name, result['appearances'], result['wins'], (0 if result['appearances'] == 0 else 100*result['wins']/result['appearances'])))
+
+        for i in sorted([ int(k) for k in self.threat_lvl_victory_struct.keys() ]):
+            result = self.threat_lvl_victory_struct[str(i)]
+            print('Threat Level {} Dungeons: {} appearances, of which adventurers won {} ({:.2f}%).  Average party level {:.2f}.'.format(i, result['appearances'], result['wins'], 0 if result['appearances'] == 0 else 100*result['wins'] / result['appearances'], 0 if result['appearances'] == 0 else 0.25 * result['total_party_level']/result['appearances']))
+
+        for key in self.beaten_by_struct.keys():
+            print('{} runs defeated by {}.'.format(self.beaten_by_struct[key], key))
+
+    def to_dict(self):
+        return({ 'runs' : self.runs, 'wins' : self.wins, 'class_results' : self.class_results_struct, 'encounter_results' : self.enc_results_struct,
+            'threat_level_results' : self.threat_lvl_victory_struct, 'beaten_by' : self.beaten_by_struct })
+
+    def load_dict(self, state):
+        self.runs = state['runs']
+        self.wins = state['wins']
+        self.class_results_struct = state['class_results']
+        self.enc_results_struct = state['encounter_results']
+        self.threat_lvl_victory_struct = state['threat_level_results']
+        self.beaten_by_struct = state['beaten_by']
+
+def iter_new_log_lines(f, offset, checkpoint):
+    # the complete lines of a log file after offset.  a half-written last line is left for next time.
+    # checkpoint['offset'] is kept up to date, so it is right however far the caller reads.
+    f.seek(offset)
+    while True:
+        line = f.readline()
+        if not line.endswith(b'\n'):
+            break
+        checkpoint['offset'] = checkpoint['offset'] + len(line)
+        yield(line.decode())
+
+def save_stats_state(state, state_location):
+    temp_location = state_location + '.tmp'
+    with open(temp_location, 'w') as state_file:
+        json.dump(state, state_file)
+    os.replace(temp_location, state_location) # never leave a half-written state behind
+
+def update_binary_dungeon_stats(world, log_location, state_location):
+    # update_dungeon_stats for a binary log.  the records are fixed width, so the checkpoint is a record count,
+    # and the log counts as rewritten if its metadata changed, it has fewer records than before, or the last
+    # record before the checkpoint is different.
+    stats = Dungeon_Stats(world)
+    records, metadata = read_binary_log(log_location)
+    start = 0
+    if os.path.exists(state_location):
+        with open(state_location) as state_file:
+            state = json.load(state_file)
+        if state.get('metadata') == metadata and state['records'] <= len(records) and (state['records'] == 0 or records[state['records'] - 1].tobytes().hex() == state['tail']):
+            stats.load_dict(state['stats'])
+            start = state['records']
+
+    for row in iter_binary_log_rows(log_location, start):
+        stats.add_row(row)
+
+    tail = records[len(records) - 1].tobytes().hex() if len(records) else ''
+    save_stats_state({ 'log' : log_location, 'metadata' : metadata, 'records' : len(records), 'tail' : tail, 'stats' : stats.to_dict() }, state_location)
+    return(stats)
+
+def update_dungeon_stats(world, log_location, state_location):
+    # Dungeon_Stats for a csv or binary log that is only ever appended to, saving the tables along with how far
+    # into the log they go, so the next call only reads the rows added since.  starts again from the top if the
+    # log has been rewritten since: a different header, fewer bytes than before, or different bytes just before
+    # the checkpoint.
+    if log_location.endswith('.bin'):
+        return(update_binary_dungeon_stats(world, log_location, state_location))
+    stats = Dungeon_Stats(world)
+    if log_location.endswith('.parquet') or log_location.endswith('.arrow'):
+        raise ValueError('incremental analysis needs a csv or binary log, not {}'.format(log_location))
+
+    with open(log_location, 'rb') as f:
+        header_line = f.readline()
+        if not header_line.endswith(b'\n'):
+            return(stats)
+        checkpoint = { 'offset' : len(header_line) }
+        if os.path.exists(state_location):
+            with open(state_location) as state_file:
+                state = json.load(state_file)
+            if state.get('header') == header_line.decode() and state['offset'] <= os.path.getsize(log_location):
+                f.seek(max(0, state['offset'] - 64))
+                tail = f.read(min(64, state['offset']))
+                if tail.hex() == state['tail']:
+                    stats.load_dict(state['stats'])
+                    checkpoint['offset'] = state['offset']
+
+        header = next(csv.reader([ header_line.decode() ], skipinitialspace=True))
+        for row in csv.reader(iter_new_log_lines(f, checkpoint['offset'], checkpoint), skipinitialspace=True):
+            stats.add_row(dict(zip(header, row)))
+
+        f.seek(max(0, checkpoint['offset'] - 64))
+        tail = f.read(min(64, checkpoint['offset']))
+
+    state = { 'log' : log_location, 'header' : header_line.decode(), 'offset' : checkpoint['offset'], 'tail' : tail.hex(), 'stats' : stats.to_dict() }
+    save_stats_state(state, state_location)
+    return(stats)
+
+def get_shard_location(location, shard_id):
+    root, extension = os.path.splitext(location)
+    return('{}.shard{}{}'.format(root, shard_id, extension))
+
+def generate_dataset_shard(seed, shard_id, runs, log_location, extended_log_location, rng_backend='mersenne'):
+    # one shard of generate_dataset, with its own rng derived from (seed, shard_id)
+    rng = make_rng('{} {}'.format(seed, shard_id), rng_backend)
+    with World(log_location=get_shard_location(log_location, shard_id), extended_log_location=get_shard_location(extended_log_location, shard_id), rng=rng) as world:
+        for i in range(runs):
+            world.run_dungeon()
+
+def merge_log_shards(location, shards):
+    # concatenates the shard logs in shard order, keeping only the first shard's header row
+    with open(location, 'w', newline='') as out_file:
+        for shard_id in range(shards):
+            shard_location = get_shard_location(location, shard_id)
+            with open(shard_location, newline='') as shard_file:
+                header = shard_file.readline()
+                if shard_id == 0:
+                    out_file.write(header)
+                for line in shard_file:
+                    out_file.write(line)
+            os.remove(shard_location)
+
+def generate_dataset(runs, seed='Dungeon Crawl Stone Soup', shards=8, workers=None, log_location='dungeon_crawl.csv', extended_log_location='dungeon_crawl_corrected.csv', rng_backend='mersenne'):
+    # like main_run, but split across a process pool.  the output only depends on seed and shards,
+    # not on the number of workers.
+    import concurrent.futures
+    shard_runs = [ runs // shards + (1 if shard_id < runs % shards else 0) for shard_id in range(shards) ]
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [ executor.submit(generate_dataset_shard, seed, shard_id, shard_runs[shard_id], log_location, extended_log_location, rng_backend) for shard_id in range(shards) ]
+        for future in futures:
+            future.result()
+    merge_log_shards(log_location, shards)
+    merge_log_shards(extended_log_location, shards)
+
+service_world = None
+def init_service_worker():
+    global service_world
+    service_world = World(log=False)
+
+def run_query_batch(string_party, encounter_names, dungeon_type, runs, seed, batch_id):
+    # worker for Simulation_Service: (runs, wins) for one batch of a query.  each batch has its own seed stream
+    # derived from (seed, batch_id), so a query always gives the same answer however the batches are scheduled.
+    world = service_world if service_world is not None else World(log=False)
+    if encounter_names is not None and np is not None:
+        party = world.get_party_by_name_and_levels(string_party)
+        return((runs, run_dungeon_batch(party, encounter_names, runs, np.random.default_rng([seed, batch_id])).wins))
+
+    world.rng = random.Random('{} {}'.format(seed, batch_id))
+    if encounter_names is not None:
+        return((runs, run_test_dungeon(world, string_party, encounter_names, runs)))
     wins = 0
-    losses = 0
-    while runs < 50000:
-        #string_party = [('Mage', 2), ('Cleric', 3), ('Rogue', 2), ('Druid', 2)]   # simon LTL
-        #string_party = [('Fighter', 4), ('Ranger', 4), ('Cleric', 3), ('Druid', 4)]  # simon ITC
-        string_party = [('Ranger', 3), ('Fighter', 4), ('Druid', 3), ('Ranger', 3)] # simon GWK
-        #string_party = [('Mage', 4), ('Cleric', 4), ('Rogue', 1), ('Ranger', 1)]   # Talentum LTL
-        #string_party = [('Fighter', 3), ('Ranger', 5), ('Mage', 1), ('Druid', 4)]  # Talentum ITC
-        #string_party = [('Ranger', 3), ('Fighter', 3), ('Cleric', 4), ('Rogue', 3)] # Talentum GWK
-        #string_party = [('Mage', 2), ('Cleric', 3), ('Rogue', 2), ('Druid', 2)]   # Yonge LTL
-        #string_party = [('Fighter', 7), ('Ranger', 3), ('Cleric', 2), ('Druid', 2)]  # Yonge ITC
-        #string_party = [('Ranger', 6), ('Fighter', 4), ('Rogue', 1), ('Cleric', 2)] # Yonge GWK
-        #string_party = [('Mage', 2), ('Cleric', 2), ('Rogue', 2), ('Druid', 2)]   # aa LTL
-        #string_party = [('Fighter', 5), ('Ranger', 3), ('Mage', 3), ('Druid', 3)]  # aa ITC
-        #string_party = [('Ranger', 4), ('Fighter', 4), ('Fighter', 3), ('Cleric', 3)] # aa GWK
-        #string_party = [('Fighter', 1), ('Ranger', 1), ('Mage', 1), ('Cleric', 3)] #Measure LTL
-        #string_party = [('Fighter', 4), ('Ranger', 3), ('Mage', 7), ('Cleric', 4)] #Measure IDC
-        #string_party = [('Fighter', 3), ('Fighter', 2), ('Ranger', 3), ('Cleric', 4)] #Measure GWK
-        #string_party = [('Mage', 1), ('Cleric', 1), ('Rogue', 5), ('Druid', 5)]   # 12 total levels
-        #string_party = [('Fighter', 3), ('Ranger', 2), ('Mage', 2), ('Druid', 6)]  # 13 total levels
-        #string_party = [('Ranger', 2), ('Fighter', 6), ('Cleric', 1), ('Cleric', 1)] #10 total levels
-        #string_party = [('Mage', 3), ('Cleric', 3), ('Rogue', 3), ('Druid', 3)]   # Class based LTL
-        #string_party = [('Fighter', 3), ('Ranger', 3), ('Mage', 3), ('Druid', 3)]  # Class based ITC
-        #string_party = [('Ranger', 3), ('Fighter', 3), ('Cleric', 3), ('Cleric', 3)] # Class based GWK
-        party = my_world.get_party_by_name_and_levels( [(x[0], x[1]) for x in string_party] )
-        dungeon = Dungeon(my_world)
-        #dungeon.encounter_names = [ 'Skeletons', 'Skeletons', 'Poison Needle Trap', 'Zombies', 'Snake Pit', 'Poison Needle Trap', 'Ghosts', 'Snake Pit' ] 
-        #dungeon.encounter_names = [ 'Snake Pit', 'Orcs', 'Snake Pit', 'Wolves', 'Dragon' ]
-        dungeon.encounter_names = [ 'Goblins', 'Boulder Trap', 'Goblins', 'Goblins', 'Boulder Trap', 'Goblins', 'Goblins', 'Boulder Trap', 'Goblins', 'Goblin Chieftain' ]
-        dungeon.get_encounters_by_name()
+    for i in range(runs):
+        dungeon = Dungeon(world)
+        while dungeon.get_threat_level() >= 10 or (dungeon_type != 'any' and dungeon.type != dungeon_type):
+            dungeon = Dungeon(world)
+        party = world.get_party_by_name_and_levels(string_party)
         party.run_dungeon(dungeon, log=False)
         if party.current_hp > 0:
             wins = wins + 1
-        else:
-            losses = losses + 1
-        runs = runs + 1
-    print('Won {}/{} ({:.2f}%)'.format(wins, runs, wins * 100 / runs))
-
-if( ad_hoc_test_runs == True  ):
-
-    possible_parties = [[]]
-    char_classes = [ 'Fighter', 'Ranger', 'Mage', 'Cleric', 'Druid', 'Rogue']
-    for char_class in char_classes:
-        new_parties = []
-        for entry in possible_parties:
-            for num_to_add in range(0,5-len(entry)):
-                alt_entry = entry + []
-                for i in range(0, num_to_add):
-                    alt_entry.append(char_class)
-                new_parties.append(alt_entry)
-        possible_parties = new_parties
-    possible_parties = [ p for p in possible_parties if len(p) == 4]
-            
-
-    my_world = World(log=False)
-    out_list = []
-
-    for possible_party in possible_parties:
+    return((runs, wins))
+
+def get_query_key(string_party, encounter_names, dungeon_type, runs, seed):
+    canonical = json.dumps({ 'party' : sorted([ [a[0], a[1]] for a in string_party ]), 'encounters' : encounter_names, 'dungeon_type' : dungeon_type, 'runs' : runs, 'seed' : seed })
+    return(hashlib.sha256(canonical.encode()).hexdigest())
+
+class Service_Query():
+    # one query being worked on.  every client that asks the same question subscribes to the same query, and gets
+    # the latest estimate straight away and every one after it.
+    def __init__(self, key, string_party, encounter_names, dungeon_type, runs, seed):
+        self.key = key
+        self.string_party = string_party
+        self.encounter_names = encounter_names
+        self.dungeon_type = dungeon_type
+        self.runs = runs
+        self.seed = seed
+        self.latest = None
+        self.subscribers = []
+
+    def subscribe(self):
+        import asyncio
+        queue = asyncio.Queue()
+        if self.latest is not None:
+            queue.put_nowait(self.latest)
+        self.subscribers.append(queue)
+        return(queue)
+
+    def publish(self, update):
+        self.latest = update
+        for queue in self.subscribers:
+            queue.put_nowait(update)
+
+    def get_batch_sizes(self, first_batch_size, batch_size):
+        # small batches first so there is an estimate quickly, then growing up to batch_size
+        sizes = []
+        size = first_batch_size
+        while sum(sizes) < self.runs:
+            sizes.append(min(size, self.runs - sum(sizes)))
+            size = min(batch_size, size * 2)
+        return(sizes)
+
+    async def run(self, executor, first_batch_size, batch_size):
+        import asyncio
+        loop = asyncio.get_running_loop()
+        futures = [ loop.run_in_executor(executor, run_query_batch, self.string_party, self.encounter_names, self.dungeon_type, size, self.seed, batch_id) for batch_id, size in enumerate(self.get_batch_sizes(first_batch_size, batch_size)) ]
         runs = 0
         wins = 0
-        losses = 0
-        while runs < 1000:
-            party = my_world.get_party_by_name_and_levels( [(x, 3) for x in possible_party] )
-            dungeon = Dungeon(my_world)
-            dungeon.encounter_names = [ 'Goblins', 'Boulder Trap', 'Goblins', 'Goblins', 'Boulder Trap', 'Goblins', 'Goblins', 'Boulder Trap', 'Goblins', 'Goblin Chieftain' ]
-            #dungeon.encounter_names = [ 'Orcs', 'Snake Pit', 'Wolves', 'Snake Pit', 'Dragon' ]
-            #dungeon.encounter_names = [ 'Skeletons', 'Poison Needle Trap', 'Zombies', 'Snake Pit', 'Poison Needle Trap', 'Skeletons', 'Snake Pit', 'Ghosts' ]
-            dungeon.get_encounters_by_name()
+        for future in asyncio.as_completed(futures):
+            batch_runs, batch_wins = await future
+            runs = runs + batch_runs
+            wins = wins + batch_wins
+            self.publish({ 'runs' : runs, 'wins' : wins, 'win_rate' : wins / runs, 'interval' : wilson_interval(wins, runs), 'done' : runs == self.runs })
+
+class Simulation_Service():
+    # answers win rate queries as JSON lines over TCP or a unix socket, from one long-lived process with a world
+    # already loaded and a process pool for the simulation.  a request looks like
+    #   { "id" : 1, "party" : "simon GWK", "dungeon" : "GWK", "runs" : 50000, "seed" : 0 }
+    # where party and dungeon are as on the command line or lists, and "dungeon" can instead be
+    # { "random" : "any" } (or "City", "Lair", "Dungeon") to run against freshly generated dungeons.
+    # the reply is a stream of { "id", "runs", "wins", "win_rate", "interval", "done" } lines, refining until done.
+    def __init__(self, workers=None, first_batch_size=250, batch_size=10000, max_runs=1000000):
+        import concurrent.futures
+        import multiprocessing
+        self.world = World(log=False)
+        # workers must not be forked from the server, or they would inherit the listening socket and the first
+        # client's connection and hold them open
+        start_method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+        self.executor = concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=init_service_worker, mp_context=multiprocessing.get_context(start_method))
+        self.first_batch_size = first_batch_size
+        self.batch_size = batch_size
+        self.max_runs = max_runs
+        self.in_flight = {}
+
+    def parse_request(self, request):
+        string_party = parse_party(request['party'], self.world)
+        dungeon = request['dungeon']
+        encounter_names = None
+        dungeon_type = None
+        if isinstance(dungeon, dict):
+            dungeon_type = dungeon.get('random', 'any')
+            if dungeon_type not in ['any', 'City', 'Lair', 'Dungeon']:
+                raise ValueError('Unknown dungeon type {}'.format(dungeon_type))
+        else:
+            encounter_names = parse_dungeon(dungeon) if isinstance(dungeon, str) else list(dungeon)
+            for e_name in encounter_names:
+                if e_name not in self.world.encounter_rules:
+                    raise ValueError('Unknown encounter {}'.format(e_name))
+        runs = min(int(request.get('runs', 50000)), self.max_runs)
+        if runs <= 0:
+            raise ValueError('runs must be positive')
+        return((string_party, encounter_names, dungeon_type, runs, int(request.get('seed', 0))))
+
+    def get_query(self, string_party, encounter_names, dungeon_type, runs, seed):
+        import asyncio
+        key = get_query_key(string_party, encounter_names, dungeon_type, runs, seed)
+        if key not in self.in_flight:
+            query = Service_Query(key, string_party, encounter_names, dungeon_type, runs, seed)
+            self.in_flight[key] = query
+            task = asyncio.get_running_loop().create_task(query.run(self.executor, self.first_batch_size, self.batch_size))
+            task.add_done_callback(lambda t: self.finish_query(query, t))
+        return(self.in_flight[key])
+
+    def finish_query(self, query, task):
+        del self.in_flight[query.key]
+        if not task.cancelled() and task.exception() is not None:
+            query.publish({ 'error' : str(task.exception()), 'done' : True })
+
+    async def send_updates(self, writer, request_id, queue):
+        while True:
+            update = await queue.get()
+            writer.write((json.dumps(dict(update, id=request_id)) + '\n').encode())
+            await writer.drain()
+            if update['done']:
+                break
+
+    async def handle_client(self, reader, writer):
+        import asyncio
+        tasks = []
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                if not line.strip():
+                    continue
+                request_id = None
+                try:
+                    request = json.loads(line)
+                    request_id = request.get('id')
+                    query = self.get_query(*self.parse_request(request))
+                except (ValueError, KeyError, TypeError, IndexError) as e:
+                    writer.write((json.dumps({ 'id' : request_id, 'error' : str(e), 'done' : True }) + '\n').encode())
+                    await writer.drain()
+                    continue
+                tasks.append(asyncio.get_running_loop().create_task(self.send_updates(writer, request_id, query.subscribe())))
+            await asyncio.gather(*tasks)
+        except ConnectionError:
+            pass
+        finally:
+            for task in tasks:
+                task.cancel()
+            writer.close()
+
+    async def serve(self, host='127.0.0.1', port=8765, unix_path=None):
+        import asyncio
+        if unix_path is not None:
+            server = await asyncio.start_unix_server(self.handle_client, unix_path)
+        else:
+            server = await asyncio.start_server(self.handle_client, host, port)
+        async with server:
+            await server.serve_forever()
+
+def run_service(host='127.0.0.1', port=8765, unix_path=None, workers=None):
+    import asyncio
+    service = Simulation_Service(workers)
+    try:
+        asyncio.run(service.serve(host, port, unix_path))
+    finally:
+        service.executor.shutdown()
+
+named_dungeons = {
+    'LTL' : [ 'Skeletons', 'Skeletons', 'Poison Needle Trap', 'Zombies', 'Snake Pit', 'Poison Needle Trap', 'Ghosts', 'Snake Pit' ],
+    'ITC' : [ 'Snake Pit', 'Orcs', 'Snake Pit', 'Wolves', 'Dragon' ],
+    'GWK' : [ 'Goblins', 'Boulder Trap', 'Goblins', 'Goblins', 'Boulder Trap', 'Goblins', 'Goblins', 'Boulder Trap', 'Goblins', 'Goblin Chieftain' ],
+}
+
+named_parties = {
+    'simon LTL' : [('Mage', 2), ('Cleric', 3), ('Rogue', 2), ('Druid', 2)],
+    'simon ITC' : [('Fighter', 4), ('Ranger', 4), ('Cleric', 3), ('Druid', 4)],
+    'simon GWK' : [('Ranger', 3), ('Fighter', 4), ('Druid', 3), ('Ranger', 3)],
+    'Talentum LTL' : [('Mage', 4), ('Cleric', 4), ('Rogue', 1), ('Ranger', 1)],
+    'Talentum ITC' : [('Fighter', 3), ('Ranger', 5), ('Mage', 1), ('Druid', 4)],
+    'Talentum GWK' : [('Ranger', 3), ('Fighter', 3), ('Cleric', 4), ('Rogue', 3)],
+    'Yonge LTL' : [('Mage', 2), ('Cleric', 3), ('Rogue', 2), ('Druid', 2)],
+    'Yonge ITC' : [('Fighter', 7), ('Ranger', 3), ('Cleric', 2), ('Druid', 2)],
+    'Yonge GWK' : [('Ranger', 6), ('Fighter', 4), ('Rogue', 1), ('Cleric', 2)],
+    'aa LTL' : [('Mage', 2), ('Cleric', 2), ('Rogue', 2), ('Druid', 2)],
+    'aa ITC' : [('Fighter', 5), ('Ranger', 3), ('Mage', 3), ('Druid', 3)],
+    'aa GWK' : [('Ranger', 4), ('Fighter', 4), ('Fighter', 3), ('Cleric', 3)],
+    'Measure LTL' : [('Fighter', 1), ('Ranger', 1), ('Mage', 1), ('Cleric', 3)],
+    'Measure ITC' : [('Fighter', 4), ('Ranger', 3), ('Mage', 7), ('Cleric', 4)],
+    'Measure GWK' : [('Fighter', 3), ('Fighter', 2), ('Ranger', 3), ('Cleric', 4)],
+    '12 total levels' : [('Mage', 1), ('Cleric', 1), ('Rogue', 5), ('Druid', 5)],
+    '13 total levels' : [('Fighter', 3), ('Ranger', 2), ('Mage', 2), ('Druid', 6)],
+    '10 total levels' : [('Ranger', 2), ('Fighter', 6), ('Cleric', 1), ('Cleric', 1)],
+    'Class based LTL' : [('Mage', 3), ('Cleric', 3), ('Rogue', 3), ('Druid', 3)],
+    'Class based ITC' : [('Fighter', 3), ('Ranger', 3), ('Mage', 3), ('Druid', 3)],
+    'Class based GWK' : [('Ranger', 3), ('Fighter', 3), ('Cleric', 3), ('Cleric', 3)],
+}
+
+gwk_encounter_names = named_dungeons['GWK']
+gwk_party = named_parties['simon GWK']
+
+# each benchmark sets up its fixed-seed workload and returns it as a function, so only the workload is timed
+
+def benchmark_fixed_party():
+    world = World(log=False, rng=random.Random('benchmark'))
+    return(lambda: run_test_dungeon(world, gwk_party, gwk_encounter_names, 10000))
+
+def benchmark_fixed_party_batch():
+    party = World(log=False).get_party_by_name_and_levels(gwk_party)
+    return(lambda: run_dungeon_batch(party, gwk_encounter_names, 50000, np.random.default_rng(0)))
+
+def benchmark_dungeon_generation():
+    world = World(log=False, rng=random.Random('benchmark'))
+    def workload():
+        for i in range(10000):
+            Dungeon(world)
+    return(workload)
+
+def benchmark_choose_adventurers():
+    world = World(log=False, rng=random.Random('benchmark'))
+    dungeons = [ d for d in [ Dungeon(world) for i in range(5000) ] if d.get_threat_level() < 10 ]
+    def workload():
+        for dungeon in dungeons:
+            world.choose_adventurers(dungeon)
+    return(workload)
+
+def benchmark_logging():
+    import tempfile
+    world = World(log=False, rng=random.Random('benchmark'))
+    runs = []
+    while len(runs) < 5000:
+        dungeon = Dungeon(world)
+        if dungeon.get_threat_level() < 10:
+            party = world.choose_adventurers(dungeon)
             party.run_dungeon(dungeon, log=False)
-            if party.current_hp > 0:
-                wins = wins + 1
+            runs.append((party, dungeon))
+    def workload():
+        with tempfile.TemporaryDirectory() as log_dir:
+            with World(log_location=os.path.join(log_dir, 'log.csv'), extended_log_location=os.path.join(log_dir, 'extended_log.csv')) as log_world:
+                for party, dungeon in runs:
+                    party.world = log_world
+                    party.log_dungeon(dungeon)
+    return(workload)
+
+def benchmark_main_run():
+    import tempfile
+    def workload():
+        with tempfile.TemporaryDirectory() as log_dir:
+            with World(log_location=os.path.join(log_dir, 'log.csv'), extended_log_location=os.path.join(log_dir, 'extended_log.csv'), rng=random.Random('Dungeon Crawl Stone Soup')) as world:
+                for i in range(2922):
+                    world.run_dungeon()
+            stats = Dungeon_Stats(world)
+            for entry in iter_log_rows(world.extended_log_location):
+                stats.add_row(entry)
+    return(workload)
+
+benchmarks = {
+    'fixed_party' : benchmark_fixed_party,
+    'fixed_party_batch' : benchmark_fixed_party_batch,
+    'dungeon_generation' : benchmark_dungeon_generation,
+    'choose_adventurers' : benchmark_choose_adventurers,
+    'logging' : benchmark_logging,
+    'main_run' : benchmark_main_run,
+}
+
+def run_benchmarks(output_location='benchmark_results.json', baseline_location='benchmark_baseline.json', tolerance=0.2, repeats=5, update_baseline=False):
+    # times each fixed-seed workload (best of `repeats`), writes the results as json, and compares them
+    # against the baseline file.  returns the names of benchmarks more than `tolerance` slower than baseline.
+    results = {}
+    for name, benchmark in benchmarks.items():
+        if benchmark == benchmark_fixed_party_batch and np is None:
+            continue
+        workload = benchmark()
+        times = []
+        for i in range(repeats):
+            start = time.perf_counter()
+            workload()
+            times.append(time.perf_counter() - start)
+        results[name] = min(times)
+    report = { 'python' : sys.version.split()[0], 'repeats' : repeats, 'seconds' : results }
+    with open(output_location, 'w') as f:
+        json.dump(report, f, indent=2)
+
+    regressions = []
+    baseline = None
+    if os.path.exists(baseline_location) and not update_baseline:
+        with open(baseline_location) as f:
+            baseline = json.load(f)['seconds']
+    for name, seconds in results.items():
+        if baseline is None or name not in baseline:
+            print('{}: {:.4f}s'.format(name, seconds))
+        else:
+            change = seconds / baseline[name] - 1
+            flag = ''
+            if change > tolerance:
+                regressions.append(name)
+                flag = '  REGRESSION'
+            print('{}: {:.4f}s ({:+.1f}% vs baseline){}'.format(name, seconds, 100 * change, flag))
+    if baseline is None:
+        with open(baseline_location, 'w') as f:
+            json.dump(report, f, indent=2)
+        print('Saved baseline to {}'.format(baseline_location))
+    return(regressions)
+
+def same_log_value(value, csv_value):
+    # whether a value read back from a log matches the csv text, e.g. a threat level of 3 reads back as 3.0 from
+    # a binary log
+    if str(value) == csv_value:
+        return(True)
+    try:
+        return(float(value) == float(csv_value))
+    except ValueError:
+        return(False)
+
+def check_log_round_trip(runs=300, seed='Round Trip'):
+    # writes the same seeded runs in every log format that iter_log_rows streams, and checks each one reads back
+    # the same extended log rows as the csv.  the formats that can be appended to are written a second time, half
+    # by a world that sets up the logs and half by a log=False world appending to them.  returns the cases that
+    # did not match.
+    import tempfile
+    log_formats = [ 'csv' ] + ([ 'parquet', 'arrow' ] if pyarrow is not None else []) + ([ 'binary' ] if np is not None else [])
+    cases = [ (log_format, False) for log_format in log_formats ] + [ (log_format, True) for log_format in log_formats if log_format in ['csv', 'binary'] ]
+    rows_by_case = {}
+    with tempfile.TemporaryDirectory() as log_dir:
+        for log_format, append in cases:
+            name = log_format + (' append' if append else '')
+            location = os.path.join(log_dir, name.replace(' ', '_') + log_extensions[log_format])
+            extended_location = os.path.join(log_dir, name.replace(' ', '_') + '_extended' + log_extensions[log_format])
+            rng = random.Random(seed)
+            for log, world_runs in ([ (True, runs // 2), (False, runs - runs // 2) ] if append else [ (True, runs) ]):
+                with World(log=log, log_location=location, extended_log_location=extended_location, log_format=log_format, rng=rng) as world:
+                    for i in range(world_runs):
+                        world.run_dungeon()
+            rows_by_case[name] = list(iter_log_rows(location if log_format == 'binary' else extended_location))
+    failures = []
+    expected = rows_by_case['csv']
+    for name, rows in rows_by_case.items():
+        same = len(rows) == len(expected) == runs and all([ same_log_value(row[k], v) for row, csv_row in zip(rows, expected) for k, v in csv_row.items() ])
+        print('{}: {}'.format(name, 'ok' if same else 'MISMATCH'))
+        if not same:
+            failures.append(name)
+    return(failures)
+
+def parse_party(party, world=None):
+    # a named party, 'Class:level,Class:level,...', or a list of [class, level] pairs as in job files and service
+    # requests, as a list of (class, level) with int levels.  raises ValueError unless it is a full party of
+    # classes that world (or a default world) knows.
+    if world is None:
+        world = World(log=False)
+    if isinstance(party, str):
+        if party in named_parties:
+            party = named_parties[party]
+        else:
+            party = [ a.split(':') for a in party.split(',') ]
+    string_party = []
+    for a in party:
+        if not isinstance(a, (list, tuple)) or len(a) != 2:
+            raise ValueError('Adventurer {} is not a class and a level'.format(':'.join([ str(x) for x in a ]) if isinstance(a, (list, tuple)) else a))
+        char_class = a[0].strip() if isinstance(a[0], str) else a[0]
+        if not isinstance(char_class, str) or char_class not in world.char_classes_by_name:
+            raise ValueError('Unknown class {}'.format(char_class))
+        level = a[1].strip() if isinstance(a[1], str) else a[1]
+        if isinstance(level, str) and level.isdigit():
+            level = int(level)
+        if not isinstance(level, int) or isinstance(level, bool) or level < 1:
+            raise ValueError('{} has level {}, not a positive whole number'.format(char_class, a[1]))
+        string_party.append((char_class, level))
+    if len(string_party) != world.party_size:
+        raise ValueError('A party needs {} adventurers, not {}'.format(world.party_size, len(string_party)))
+    return(string_party)
+
+def parse_dungeon(text):
+    # a named dungeon, or 'Encounter,Encounter,...'
+    if text in named_dungeons:
+        return(named_dungeons[text])
+    return([ e_name.strip() for e_name in text.split(',') ])
+
+def load_job_file(location):
+    # { 'parties' : [...], 'dungeons' : [...], and optionally 'runs', 'method', 'seed' }.  parties and dungeons can
+    # be names or strings as on the command line, or lists ([['Fighter', 3], ...] and ['Goblins', ...]).
+    with open(location) as f:
+        if location.endswith('.yaml') or location.endswith('.yml'):
+            import yaml # only needed for yaml job files
+            job = yaml.safe_load(f)
+        else:
+            job = json.load(f)
+    job['parties'] = [ parse_party(p) for p in job['parties'] ]
+    job['dungeons'] = [ parse_dungeon(d) if isinstance(d, str) else d for d in job['dungeons'] ]
+    return(job)
+
+def evaluate_parties(string_parties, dungeons, runs=50000, method='simulate', seed='Dungeon Crawl Stone Soup', cache_location=None, encounter_specs=None, rng_backend='mersenne'):
+    # runs every party against every encounter list in one world, printing each win rate
+    world = World(log=False, rng=make_rng(seed, rng_backend), encounter_specs=encounter_specs)
+    cache = Result_Cache(cache_location) if cache_location is not None else None
+    if method == 'batch':
+        batch_rng = np.random.default_rng(int(hashlib.sha256(str(seed).encode()).hexdigest()[:16], 16))
+    for encounter_names in dungeons:
+        for string_party in string_parties:
+            label = '{} vs {}'.format(string_party, encounter_names)
+            if method == 'exact':
+                result = solve_dungeon_exact(world.get_party_by_name_and_levels(string_party), encounter_names)
+                print('{}: win chance {:.4f}%'.format(label, result.win_probability * 100))
+                continue
+            if cache is not None:
+                result = cache.run_test_dungeon(world, string_party, encounter_names, runs, seed, method, rng_backend)
+                wins = result['wins']
+                runs_done = result['runs']
+            elif method == 'batch':
+                wins = run_dungeon_batch(world.get_party_by_name_and_levels(string_party), encounter_names, runs, batch_rng).wins
+                runs_done = runs
             else:
-                losses = losses + 1
-            runs = runs + 1
-        out_list.append({ 'party' : possible_party, 'win_rate' : wins / runs})
-
-    out_list.sort(key=lambda struct: struct['win_rate'])
+                wins = run_test_dungeon(world, string_party, encounter_names, runs)
+                runs_done = runs
+            print('{}: Won {}/{} ({:.2f}%)'.format(label, wins, runs_done, wins * 100 / runs_done))
+    if cache is not None:
+        cache.close()
+
+def generate_command(args):
+    if args.shards > 1:
+        generate_dataset(args.runs, args.seed, args.shards, args.workers, args.log or 'dungeon_crawl.csv', args.extended_log or 'dungeon_crawl_corrected.csv', args.rng)
+    else:
+        with World(log_location=args.log, extended_log_location=args.extended_log, log_format=args.format, rng=make_rng(args.seed, args.rng)) as world:
+            for i in range(args.runs):
+                world.run_dungeon()
+
+def evaluate_command(args):
+    encounter_specs = load_encounter_specs(args.encounter_specs) if args.encounter_specs is not None else None
+    if args.job is not None:
+        job = load_job_file(args.job)
+        evaluate_parties(job['parties'], job['dungeons'], job.get('runs', args.runs), job.get('method', args.method), job.get('seed', args.seed), args.cache, encounter_specs, args.rng)
+    else:
+        evaluate_parties([ parse_party(p) for p in args.party ], [ parse_dungeon(d) for d in args.dungeon ], args.runs, args.method, args.seed, args.cache, encounter_specs, args.rng)
+
+def search_command(args):
+    if args.shortlist is not None:
+        world = World(log=False)
+        candidates = get_possible_parties(world, args.min_level, args.max_level, args.max_total_level)
+        for entry in screen_parties(world, candidates, parse_dungeon(args.dungeon), args.shortlist, args.top_k):
+            print(entry)
+        return
+    out_list = search_parties(parse_dungeon(args.dungeon), args.runs, args.top_k, args.min_level, args.max_level, args.max_total_level, args.seed, args.workers)
     for entry in out_list:
         print(entry)
-    overall_winrate = sum([entry['win_rate'] for entry in out_list]) / len(out_list)
-    print('Random winrate: {:.2f}%'.format(100*overall_winrate))
-        
-        
-if( main_run == True):
-    random.seed('Dungeon Crawl Stone Soup')
-    my_world = World()
-    for i in range(0,2922):
-        my_world.run_dungeon()
-
 
-    # tracking data:
-    with open('dungeon_crawl_corrected.csv') as f:
-        a = [{k: v for k, v in row.items()}
-            for row in csv.DictReader(f, skipinitialspace=True)]
-
-    runs = len(a)
-    wins = len([e for e in a if e['Victory?'] == '1'])
-    print('{}/ {} runs won in total ({:.2f}%)'.format(wins, runs, 100 * wins / runs))
-
-    class_results_struct = {}
-    for char_class in my_world.char_classes:
-        class_results_struct[char_class.name] = {'appearances' : 0, 'wins' : 0, 'losses' : 0, 'total_level' : 0}
-
-    for entry in a:
-        for char_class in my_world.char_classes:
-            num = int(entry['# of {} Adventurers'.format(char_class.name)])
-            class_results_struct[char_class.name]['appearances'] = class_results_struct[char_class.name]['appearances'] + num
-            lvl = int(entry['Total Level of {} Adventurers'.format(char_class.name)])
-            class_results_struct[char_class.name]['total_level'] = class_results_struct[char_class.name]['total_level'] + lvl
-            win = int(entry['Victory?'])
-            class_results_struct[char_class.name]['wins'] = class_results_struct[char_class.name]['wins'] + (num * win)
-            class_results_struct[char_class.name]['losses'] = class_results_struct[char_class.name]['losses'] + (num * (1-win))
-
-
-    for char_class in my_world.char_classes:
-        result = class_results_struct[char_class.name]
-        print('{}:\n{} appearances.\n{} won ({:.2f}%).\nAverage Level {:.2f}.'.format(char_class.name, result['appearances'], result['wins'], 100*result['wins']/result['appearances'], result['total_level']/result['appearances']))
-
-    encounter_names = [ e.name for e in my_world.encounter_types]
-
-    enc_results_struct = {}
-    for e in encounter_names:
-        enc_results_struct[e] = {'appearances' : 0, 'wins': 0}
-
-    for entry in a:
-        for e in encounter_names:
-            num = int(entry['# of {} Encounters'.format(e)])
-            win = int(entry['Victory?'])
-            enc_results_struct[e]['appearances'] = enc_results_struct[e]['appearances'] + num
-            enc_results_struct[e]['wins'] = enc_results_struct[e]['wins'] + (num * win)
-
-    for e in encounter_names:
-        result = enc_results_struct[e]
-        print('{}: {} known appearances, of which adventurers won {} ({:.2f}%)'.format(e, result['appearances'], result['wins'], (0 if result['appearances'] == 0 else 100*result['wins']/result['appearances'])))
-            
-            
-    threat_lvl_victory_struct = {}
-    for i in range(1,10):
-        threat_lvl_victory_struct[str(i)] = {'appearances' : 0, 'wins' : 0, 'total_party_level' : 0}
-
-    for entry in a:
-        threat_lvl = float(entry['Threat Level'])
-        total_party_level = int(entry['Adventurer 1 Level']) + int(entry['Adventurer 2 Level']) + int(entry['Adventurer 3 Level']) + int(entry['Adventurer 4 Level'])
-        win = int(entry['Victory?'])
-        threat_lvl = str(math.ceil(threat_lvl))
-        threat_lvl_victory_struct[threat_lvl]['appearances'] = threat_lvl_victory_struct[threat_lvl]['appearances'] + 1
-        threat_lvl_victory_struct[threat_lvl]['wins'] = threat_lvl_victory_struct[threat_lvl]['wins'] + win
-        threat_lvl_victory_struct[threat_lvl]['total_party_level'] = threat_lvl_victory_struct[threat_lvl]['total_party_level'] + total_party_level
-
-        
-    for i in range(1,10):
-        result = threat_lvl_victory_struct[str(i)]
-        print('Threat Level {} Dungeons: {} appearances, of which adventurers won {} ({:.2f}%).  Average party level {:.2f}.'.format(i, result['appearances'], result['wins'], 0 if result['appearances'] == 0 else 100*result['wins'] / result['appearances'], 0 if result['appearances'] == 0 else 0.25 * result['total_party_level']/result['appearances']))
-        
-    beaten_by_struct = {}
-    for entry in a:
-        if entry['Defeated By'] != '':
-            if entry['Defeated By'] in beaten_by_struct.keys():
-                beaten_by_struct[entry['Defeated By']] = beaten_by_struct[entry['Defeated By']] + 1
-            else:
-                beaten_by_struct[entry['Defeated By']] = 1
-
-    for key in beaten_by_struct.keys():
-        print('{} runs defeated by {}.'.format(beaten_by_struct[key], key))
-        
+def orderings_command(args):
+    world = World(log=False)
+    party = world.get_party_by_name_and_levels(parse_party(args.party))
+    encounter_names = parse_dungeon(args.dungeon)
+    fixed_suffix = encounter_names[-1:] if args.fixed_boss else []
+    rooms = encounter_names[:len(encounter_names) - len(fixed_suffix)]
+    shuffled = solve_shuffled_dungeon(party, rooms, fixed_suffix)
+    print('Win chance after a shuffle: {:.4f}%'.format(shuffled.win_probability * 100))
+    if args.show > 0:
+        result = solve_all_orderings(party, rooms, fixed_suffix)
+        print('{} distinct orderings'.format(result.count))
+        for ordering, win_probability in result.orderings[:args.show]:
+            print('{:.4f}% {}'.format(win_probability * 100, list(ordering)))
+        print('...')
+        for ordering, win_probability in result.orderings[-args.show:]:
+            print('{:.4f}% {}'.format(win_probability * 100, list(ordering)))
+
+def marginal_command(args):
+    report = get_marginal_values(World(log=False), parse_party(args.party), parse_dungeon(args.dungeon), args.runs, args.seed, args.min_level, args.max_level)
+    print('{}: win rate {:.2f}% over {} runs'.format(report['party'], report['win_rate'] * 100, report['runs']))
+    for change in report['changes']:
+        print('{:+.2f}% (+/- {:.2f}%) {}'.format(change['delta'] * 100, change['std_error'] * 100, change['change']))
+
+def serve_command(args):
+    run_service(args.host, args.port, args.unix_socket, args.workers)
+
+def analyze_command(args):
+    if args.state is not None:
+        stats = update_dungeon_stats(World(log=False), args.log, args.state)
+    else:
+        stats = Dungeon_Stats(World(log=False))
+        for entry in iter_log_rows(args.log):
+            stats.add_row(entry)
+    stats.print_self()
+
+def check_command(args):
+    if len(check_log_round_trip()):
+        sys.exit(1)
+
+def benchmark_command(args):
+    regressions = run_benchmarks(args.output, args.baseline, args.tolerance, args.repeats, args.update_baseline)
+    if len(regressions):
+        sys.exit(1)
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description='Dungeon crawl simulator')
+    parser.add_argument('--verbose', action='store_true', help='print every encounter')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    generate = subparsers.add_parser('generate', help='generate a dataset of random dungeon runs (the old main_run)')
+    generate.add_argument('--runs', type=int, default=2922)
+    generate.add_argument('--seed', default='Dungeon Crawl Stone Soup')
+    generate.add_argument('--shards', type=int, default=1, help='split across this many seeded shards and worker processes')
+    generate.add_argument('--workers', type=int, default=None)
+    generate.add_argument('--format', choices=sorted(log_extensions.keys()), default='csv', help='only csv can be sharded')
+    generate.add_argument('--rng', choices=sorted(rng_backends.keys()), default='mersenne', help='only mersenne reproduces the original datasets')
+    generate.add_argument('--log', default=None)
+    generate.add_argument('--extended-log', default=None)
+    generate.set_defaults(func=generate_command)
+
+    evaluate = subparsers.add_parser('evaluate', help='win rates of parties against fixed encounter lists')
+    evaluate.add_argument('--party', action='append', default=[], help="a named party, or 'Class:level,...'; repeatable")
+    evaluate.add_argument('--dungeon', action='append', default=[], help="a named dungeon, or 'Encounter,...'; repeatable")
+    evaluate.add_argument('--job', default=None, help='json or yaml file listing parties and dungeons')
+    evaluate.add_argument('--runs', type=int, default=50000)
+    evaluate.add_argument('--method', choices=['simulate', 'batch', 'exact'], default='simulate')
+    evaluate.add_argument('--seed', default='Dungeon Crawl Stone Soup')
+    evaluate.add_argument('--cache', default=None, help='sqlite result cache to reuse and extend')
+    evaluate.add_argument('--rng', choices=sorted(rng_backends.keys()), default='mersenne')
+    evaluate.add_argument('--encounter-specs', default=None, help='JSON list of encounter specs to use instead of the built-in ones')
+    evaluate.set_defaults(func=evaluate_command)
+
+    search = subparsers.add_parser('search', help='find the best parties for an encounter list')
+    search.add_argument('--dungeon', default='GWK')
+    search.add_argument('--runs', type=int, default=1000)
+    search.add_argument('--top-k', type=int, default=20)
+    search.add_argument('--min-level', type=int, default=1)
+    search.add_argument('--max-level', type=int, default=8)
+    search.add_argument('--max-total-level', type=int, default=None)
+    search.add_argument('--seed', type=int, default=0)
+    search.add_argument('--workers', type=int, default=None)
+    search.add_argument('--shortlist', type=int, default=None, help='screen every party with the threat table, and solve only this many exactly')
+    search.set_defaults(func=search_command)
+
+    orderings = subparsers.add_parser('orderings', help='exact win chances over the orderings of an encounter list')
+    orderings.add_argument('--party', required=True)
+    orderings.add_argument('--dungeon', required=True)
+    orderings.add_argument('--fixed-boss', action='store_true', help='keep the last encounter last, as cities and lairs do')
+    orderings.add_argument('--show', type=int, default=5, help='print the best and worst this many orderings (0 for just the shuffled chance)')
+    orderings.set_defaults(func=orderings_command)
+
+    marginal = subparsers.add_parser('marginal', help='change in win rate from levelling or swapping each adventurer')
+    marginal.add_argument('--party', required=True)
+    marginal.add_argument('--dungeon', required=True)
+    marginal.add_argument('--runs', type=int, default=5000)
+    marginal.add_argument('--seed', type=int, default=0)
+    marginal.add_argument('--min-level', type=int, default=1)
+    marginal.add_argument('--max-level', type=int, default=8)
+    marginal.set_defaults(func=marginal_command)
+
+    serve = subparsers.add_parser('serve', help='answer win rate queries as JSON lines over TCP or a unix socket')
+    serve.add_argument('--host', default='127.0.0.1')
+    serve.add_argument('--port', type=int, default=8765)
+    serve.add_argument('--unix-socket', default=None)
+    serve.add_argument('--workers', type=int, default=None)
+    serve.set_defaults(func=serve_command)
+
+    analyze = subparsers.add_parser('analyze', help='summary tables for an extended log')
+    analyze.add_argument('--log', default='dungeon_crawl_corrected.csv')
+    analyze.add_argument('--state', default=None, help='saved tables to update with only the rows added since the last run (csv logs only)')
+    analyze.set_defaults(func=analyze_command)
+
+    check = subparsers.add_parser('check', help='check every log format reads back the same rows')
+    check.set_defaults(func=check_command)
+
+    benchmark = subparsers.add_parser('benchmark', help='time the simulator hot paths against a baseline')
+    benchmark.add_argument('--output', default='benchmark_results.json')
+    benchmark.add_argument('--baseline', default='benchmark_baseline.json')
+    benchmark.add_argument('--tolerance', type=float, default=0.2)
+    benchmark.add_argument('--repeats', type=int, default=5)
+    benchmark.add_argument('--update-baseline', action='store_true')
+    benchmark.set_defaults(func=benchmark_command)
+
+    args = parser.parse_args(argv)
+    if args.command == 'generate' and args.shards > 1 and args.format != 'csv':
+        parser.error('only csv logs can be sharded, not {}'.format(args.format))
+    if args.command == 'evaluate' and args.job is None and (len(args.party) == 0 or len(args.dungeon) == 0):
+        parser.error('evaluate needs --job, or at least one --party and one --dungeon')
+    global global_verbose_flag
+    global_verbose_flag = args.verbose
+    args.func(args)
+
+if __name__ == '__main__':
+    main()
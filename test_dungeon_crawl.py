@@ -0,0 +1,162 @@
+import collections
+import hashlib
+import itertools
+import math
+import random
+
+import pytest
+
+import dungeon_crawl
+from dungeon_crawl import World, Dungeon, Alias_Table, named_parties, named_dungeons
+
+needs_numpy = pytest.mark.skipif(dungeon_crawl.np is None, reason='needs numpy')
+
+# md5 digests of what the original script wrote and printed with its fixed seed
+original_log_md5 = 'a45b0102e27f26ee376ed24e8b9e0e06'
+original_extended_log_md5 = '97c9fa393555de640faf2f862e8d7069'
+original_analysis_md5 = '8509edd1fb2db30eb76ccae376e8d7a9'
+
+def get_md5(location):
+    with open(location, 'rb') as f:
+        return(hashlib.md5(f.read()).hexdigest())
+
+def get_alias_probabilities(table):
+    # the chance of drawing each option, worked out from the table rather than by drawing
+    n = len(table.options)
+    probabilities = [ 0.0 for o in table.options ]
+    for i in range(n):
+        probabilities[i] = probabilities[i] + table.probs[i] / n
+        probabilities[table.aliases[i]] = probabilities[table.aliases[i]] + (1 - table.probs[i]) / n
+    return(probabilities)
+
+def get_chi_squared(counts, probabilities, draws):
+    # pools the cells expected fewer than 5 times into one.  returns (statistic, degrees of freedom)
+    statistic = 0
+    pooled_count = 0
+    pooled_expected = 0
+    cells = 0
+    for count, p in zip(counts, probabilities):
+        if p * draws < 5:
+            pooled_count = pooled_count + count
+            pooled_expected = pooled_expected + p * draws
+        else:
+            statistic = statistic + (count - p * draws) ** 2 / (p * draws)
+            cells = cells + 1
+    if pooled_expected > 0:
+        statistic = statistic + (pooled_count - pooled_expected) ** 2 / pooled_expected
+        cells = cells + 1
+    return((statistic, cells - 1))
+
+def check_chi_squared(counts, probabilities, draws):
+    # far beyond the 1e-6 tail, so only a real difference in distribution fails
+    statistic, degrees_of_freedom = get_chi_squared(counts, probabilities, draws)
+    assert statistic < degrees_of_freedom + 7 * math.sqrt(2 * degrees_of_freedom), (statistic, degrees_of_freedom)
+
+def test_alias_table_probabilities_are_exact():
+    rng = random.Random('alias')
+    weights = [ rng.random() for i in range(40) ] + [ 0.001, 5.0 ]
+    table = Alias_Table(list(range(len(weights))), weights)
+    for p, w in zip(get_alias_probabilities(table), weights):
+        assert abs(p - w / sum(weights)) < 1e-12
+
+def test_alias_table_draws_fit_weights():
+    weights = [ 1, 2, 3, 4, 10, 0.5 ]
+    table = Alias_Table(list(range(len(weights))), weights)
+    rng = random.Random('alias draws')
+    draws = 100000
+    counts = collections.Counter([ table.draw(rng) for i in range(draws) ])
+    check_chi_squared([ counts[i] for i in range(len(weights)) ], [ w / sum(weights) for w in weights ], draws)
+
+def test_direct_sampling_matches_rejection_sampling():
+    # the first adventurer choose_adventurers accepts should follow the alias table choose_adventurers_direct uses
+    world = World(log=False, rng=random.Random('sampling'))
+    dungeon = Dungeon(world)
+    while dungeon.get_threat_level() >= 10:
+        dungeon = Dungeon(world)
+    table = world.get_adventurer_alias_table(dungeon.get_threat_level(), tuple([ 0 for c in world.char_classes ]))
+    draws = 20000
+    counts = collections.Counter()
+    for i in range(draws):
+        a = world.choose_adventurers(dungeon).adventurers[0]
+        counts[(a.char_class, a.level)] += 1
+    assert sum([ counts[o] for o in table.options ]) == draws
+    check_chi_squared([ counts[o] for o in table.options ], get_alias_probabilities(table), draws)
+
+def get_test_party(world):
+    return(world.get_party_by_name_and_levels([ ('Fighter', 2), ('Mage', 2), ('Rogue', 1), ('Druid', 1) ]))
+
+def test_all_orderings_match_brute_force():
+    world = World(log=False)
+    party = get_test_party(world)
+    rooms = [ 'Goblins', 'Goblins', 'Wolves', 'Orc Shaman', 'Boulder Trap' ]
+    suffix = [ 'Goblin Chieftain' ]
+    brute_force = { ordering : dungeon_crawl.solve_dungeon_exact(party, list(ordering) + suffix).win_probability for ordering in set(itertools.permutations(rooms)) }
+    result = dungeon_crawl.solve_all_orderings(party, rooms, suffix)
+    assert result.count == len(brute_force)
+    for ordering, win_probability in result.orderings:
+        assert abs(win_probability - brute_force[ordering[:len(rooms)]]) < 1e-12
+    assert abs(result.best[1] - max(brute_force.values())) < 1e-12
+    assert abs(result.worst[1] - min(brute_force.values())) < 1e-12
+    assert abs(result.mean_win_probability - sum(brute_force.values()) / len(brute_force)) < 1e-12
+
+def test_shuffled_dungeon_matches_brute_force():
+    # every permutation of a shuffle is equally likely, so the result is the average over all of them
+    world = World(log=False)
+    party = get_test_party(world)
+    rooms = [ 'Goblins', 'Goblins', 'Wolves', 'Orc Shaman', 'Boulder Trap' ]
+    suffix = [ 'Goblin Chieftain' ]
+    results = [ dungeon_crawl.solve_dungeon_exact(party, list(ordering) + suffix) for ordering in itertools.permutations(rooms) ]
+    shuffled = dungeon_crawl.solve_shuffled_dungeon(party, rooms, suffix)
+    assert abs(shuffled.win_probability - sum([ r.win_probability for r in results ]) / len(results)) < 1e-12
+    for i, death_probability in enumerate(shuffled.death_probabilities):
+        assert abs(death_probability - sum([ r.death_probabilities[i] for r in results ]) / len(results)) < 1e-12
+
+def test_generate_matches_original_main_run(tmp_path, capsys):
+    log_location = str(tmp_path / 'dungeon_crawl.csv')
+    extended_log_location = str(tmp_path / 'dungeon_crawl_corrected.csv')
+    dungeon_crawl.main([ 'generate', '--log', log_location, '--extended-log', extended_log_location ])
+    assert get_md5(log_location) == original_log_md5
+    assert get_md5(extended_log_location) == original_extended_log_md5
+    capsys.readouterr()
+    dungeon_crawl.main([ 'analyze', '--log', extended_log_location ])
+    assert hashlib.md5(capsys.readouterr().out.encode()).hexdigest() == original_analysis_md5
+
+def check_win_rate(wins, runs, win_probability):
+    assert abs(wins / runs - win_probability) <= 4.5 * math.sqrt(win_probability * (1 - win_probability) / runs) + 1e-12
+
+@needs_numpy
+@pytest.mark.parametrize('dungeon_name', [ 'LTL', 'ITC', 'GWK' ])
+def test_batch_and_exact_agree_with_run_dungeon(dungeon_name):
+    world = World(log=False, rng=random.Random(dungeon_name))
+    string_party = named_parties['simon {}'.format(dungeon_name)]
+    encounter_names = named_dungeons[dungeon_name]
+    party = world.get_party_by_name_and_levels(string_party)
+    win_probability = dungeon_crawl.solve_dungeon_exact(party, encounter_names).win_probability
+    runs = 20000
+    check_win_rate(dungeon_crawl.run_test_dungeon(world, string_party, encounter_names, runs), runs, win_probability)
+    batch_result = dungeon_crawl.run_dungeon_batch(party, encounter_names, runs, dungeon_crawl.np.random.default_rng(0))
+    check_win_rate(batch_result.wins, runs, win_probability)
+
+@needs_numpy
+def test_empty_dungeon_is_always_won():
+    world = World(log=False)
+    string_party = named_parties['simon GWK']
+    party = world.get_party_by_name_and_levels(string_party)
+    assert dungeon_crawl.solve_dungeon_exact(party, []).win_probability == 1.0
+    assert dungeon_crawl.run_test_dungeon(world, string_party, [], 10) == 10
+    assert dungeon_crawl.run_dungeon_batch(party, [], 1000).win_rate() == 1.0
+
+@needs_numpy
+def test_binary_log_appends_every_run(tmp_path):
+    log_location = str(tmp_path / 'log.bin')
+    with World(log_location=log_location, log_format='binary', rng=random.Random('append')) as world:
+        for i in range(10):
+            world.run_dungeon()
+    with World(log=False, log_location=log_location, log_format='binary', rng=random.Random('append more')) as world:
+        for i in range(5):
+            world.run_dungeon()
+    assert len(dungeon_crawl.read_binary_log(log_location)[0]) == 15
+
+def test_logs_round_trip():
+    # every log format, including appending from a log=False world, reads back the rows the csv log holds
+    assert dungeon_crawl.check_log_round_trip(runs=200) == []